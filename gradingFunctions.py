@@ -1,9 +1,8 @@
-import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import os, importlib, shutil, zipfile, json, time, subprocess
+import os, importlib, shutil, zipfile, json, time, subprocess, signal, hashlib, re, tempfile, contextlib
+import asyncio, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-def setupCourse(course_name, temppath=os.path.join(os.getcwd(),'temp'), folder_path=os.getcwd()):
+def setupCourse(course_name, temppath=os.path.join(os.getcwd(),'temp'), folder_path=os.getcwd(), gradebook_path=None):
     """
     Function that will setup an nbgrader course with all necessary directories for students. 
     This will:
@@ -31,15 +30,14 @@ def setupCourse(course_name, temppath=os.path.join(os.getcwd(),'temp'), folder_p
                         this script requires a Blackboard dummy .csv with columns "First Name", "Last Name", and "Username".
                         Defult is set to the current working directory.
     folder_path (str) : full path to the location where you want the course setup. Defult is set to the current working directory. 
+    gradebook_path (str) : path to the Blackboard gradebook .csv. When given there is no prompt and the temp folder is not searched.
+                           Students are added to the course gradebook.db with syncRoster().
     """
-
     # Checking that nbgrader is properly installed
     assert importlib.util.find_spec('nbgrader') is not None, 'You Need to Install nbgrader!' 
 
     # Creating a nbgrader course
-    os.chdir(folder_path)
-    subprocess.run(["nbgrader", "quickstart", course_name])
-    time.sleep(5)
+    subprocess.run(["nbgrader", "quickstart", course_name], cwd=folder_path)
     cpath = os.path.join(folder_path,course_name)
     subpath = cpath + '/submitted'
     scpath = cpath + '/scratch'
@@ -52,90 +50,2189 @@ def setupCourse(course_name, temppath=os.path.join(os.getcwd(),'temp'), folder_p
     if next((t for t in os.listdir(folder_path) if 'temp' in t), None) == None:
         os.mkdir(temppath)
 
-    print('------------------------------------------------------------------')
-    input('Move Gradebook File into temp folder. Hit enter once this is done.')
+    if gradebook_path is None:
+        print('------------------------------------------------------------------')
+        input('Move Gradebook File into temp folder. Hit enter once this is done.')
     
-    # Setting up student directories
+    # Setting up student directories and the course gradebook.db in one go
     try:
-        gr_path = os.path.join(temppath, next((cs for cs in os.listdir(temppath) if 'csv' in cs), None))
-        gr = pd.read_csv(gr_path)
-        last, first, users = gr['Last Name'], gr['First Name'], gr['Username']
+        gr_path = gradebook_path or os.path.join(temppath, next((cs for cs in os.listdir(temppath) if 'csv' in cs), None))
     except TypeError:
         print('Temporary Folder is Empty')
+        return
+    changes = syncRoster(course_name, gr_path, opath=folder_path)
 
-    for user in users:
-        try:
-            user_path = subpath + f'/{user}'
-            os.mkdir(user_path)
-        except FileExistsError:
+    print(f'Course: {course_name} created succesfully with {int((changes["action"] != "remove").sum())} students.')
+
+def _read_roster(gradebook_path):
+    """
+    Username, First Name and Last Name of every student in a Blackboard gradebook .csv, as strings (missing names are
+    None), one row per username.
+    """
+    import pandas as pd
+
+    roster = pd.read_csv(gradebook_path, dtype=str)[['Username', 'First Name', 'Last Name']]
+    roster = roster.dropna(subset=['Username']).drop_duplicates('Username', keep='last')
+    roster['Username'] = roster['Username'].str.strip()
+    return roster.astype(object).where(roster.notna(), None)
+
+def syncRoster(coursename, gradebook_path, opath=os.getcwd(), remove=False, dry_run=False):
+    """
+    Brings the students in the course gradebook.db in line with a Blackboard gradebook .csv, e.g. after mid-semester
+    enrollment changes. New students are added, students whose name changed are updated and, with remove, dropped
+    students are removed, all in a single database transaction through nbgrader's Python API. Missing
+    submitted/username folders are created as well.
+
+    -------------------------
+    Inputs
+    -------------------------
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    gradebook_path (str) : Blackboard gradebook .csv with "Username", "First Name" and "Last Name" columns.
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    remove (bool) : remove students that are no longer in the gradebook. Students with submissions are always kept
+                    (removing them would delete their grades) and are only reported.
+    dry_run (bool) : only print and return the changes, nothing is written.
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per change: username, action ('add', 'update', 'remove' or 'keep' for dropped
+    students that stay in the database), first_name and last_name.
+    """
+    import pandas as pd
+    from nbgrader.api import Gradebook, Student
+
+    coursepath = os.path.join(opath, coursename)
+    subpath = os.path.join(coursepath, 'submitted')
+    roster = _read_roster(gradebook_path)
+
+    changes = []
+    with Gradebook('sqlite:///' + os.path.join(coursepath, 'gradebook.db'), coursename) as gb:
+        current = {student.id: student for student in gb.db.query(Student)}
+        for user, first, last in roster.itertuples(index=False):
+            student = current.get(user)
+            if student is None:
+                changes.append((user, 'add', first, last))
+                if not dry_run:
+                    gb.db.add(Student(id=user, first_name=first, last_name=last))
+            elif (student.first_name, student.last_name) != (first, last):
+                changes.append((user, 'update', first, last))
+                if not dry_run:
+                    student.first_name, student.last_name = first, last
+
+        for user in sorted(set(current) - set(roster['Username'])):
+            student = current[user]
+            if remove and not student.submissions:
+                changes.append((user, 'remove', student.first_name, student.last_name))
+                if not dry_run:
+                    gb.db.delete(student)
+            else:
+                changes.append((user, 'keep', student.first_name, student.last_name))
+
+        if not dry_run:
+            try:
+                gb.db.commit()
+            except Exception:
+                gb.db.rollback()
+                raise
+
+    if not dry_run:
+        existing = set(os.listdir(subpath)) if os.path.exists(subpath) else set()
+        for user in set(roster['Username']) - existing:
+            os.makedirs(os.path.join(subpath, user), exist_ok=True)
+
+    changes = pd.DataFrame(changes, columns=['username', 'action', 'first_name', 'last_name'])
+    counts = changes['action'].value_counts()
+    print(f"{'Would apply' if dry_run else 'Applied'} roster changes: "
+          + ', '.join(f'{counts.get(a, 0)} {a}' for a in ['add', 'update', 'remove']))
+    kept = changes.loc[changes['action'] == 'keep', 'username'].tolist()
+    if kept:
+        print(f'{len(kept)} students are not in the gradebook but were kept'
+              f'{" (they have submissions)" if remove else ""}: {", ".join(kept)}')
+    return changes
+
+# A test cell earns partial credit only when its cell in the instructor's source notebook has a "# TESTS" line. The
+# checks and their weights are the literal check('name', test, weight) calls of that cell, see _declared_checks().
+# The cell ends by displaying {name: passed} as this MIME type, and only that last output of the cell is read.
+TEST_RESULT_MIME = 'application/x-grading-test+json'
+_TEST_CELL = re.compile(r'^\s*#\s*TESTS\s*$', re.MULTILINE)
+
+def _declared_checks(source):
+    """
+    {name: weight} of the check('name', test, weight=1) calls in the source of a test cell. Only calls with a
+    string literal name and a numeric literal weight count, so a check cannot be added or reweighted at run time.
+    """
+    import ast
+
+    try:
+        tree = ast.parse('\n'.join(l for l in source.splitlines() if not l.lstrip().startswith(('%', '!'))))
+    except SyntaxError:
+        return {}
+    checks = {}
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'check'
+                and node.args and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str)):
             continue
-    sn_df = pd.DataFrame({'id':gr['Username'],
-                      'first_name':gr['First Name'],
-                      'last_name':gr['Last Name'] })
+        weight = node.args[2] if len(node.args) > 2 else next((k.value for k in node.keywords if k.arg == 'weight'),
+                                                              ast.Constant(1))
+        if isinstance(weight, ast.Constant) and isinstance(weight.value, (int, float)) \
+                and not isinstance(weight.value, bool) and weight.value > 0:
+            checks[node.args[0].value] = float(weight.value)
+    return checks
+
+def _score_cell(points, outputs, checks=None):
+    """
+    Points earned by one autograder test cell from its outputs, a list of {'output_type', 'name', 'plain', 'tests'}.
+
+    A cell with declared checks ({name: weight} from the source notebook, see _source_tests()) earns points times
+    the weight of its passed checks over the weight of all of them. The results are only taken from the last output
+    of the cell when it is the TEST_RESULT_MIME display and the cell raised no error. Results for undeclared names
+    are ignored and the weights never come from the output. Any other cell is scored like nbgrader does: an error or
+    stderr output earns 0, a number as the result earns that many points (if it is between 0 and points) and
+    anything else earns full points.
+    """
+    if checks is not None:
+        total = sum(checks.values())
+        if not total or not outputs or any(o['output_type'] == 'error' for o in outputs) \
+                or not isinstance(outputs[-1]['tests'], dict):
+            return 0.0
+        passed = sum(weight for name, weight in checks.items() if outputs[-1]['tests'].get(name) is True)
+        return points * passed / total
+
+    for o in outputs:
+        if o['output_type'] == 'error' or o['output_type'] == 'stream' and o['name'] == 'stderr':
+            return 0.0
+        if o['output_type'] == 'execute_result':
+            try:
+                partial = float(o['plain'])
+            except ValueError:
+                return points
+            return partial if 0 <= partial <= points else points
+    return points
 
-    subprocess.run(["nbgrader", "db", "student", "remove", "bitdiddle"])
-    subprocess.run(["nbgrader", "db", "student", "remove", "hacker"])
-    sn_df.to_csv('tmp.csv')
-    subprocess.run(["nbgrader", "db", "student", "import", "tmp.csv"])
-    os.remove('tmp.csv')
+def _source_tests(coursepath, aname):
+    """
+    {grade_id: {check name: weight}} of the test cells in source/aname/aname.ipynb that opt in to partial credit
+    with a "# TESTS" line, see _declared_checks() and _score_cell().
+    """
+    source_path = os.path.join(coursepath, 'source', aname, f'{aname}.ipynb')
+    if not os.path.exists(source_path):
+        return {}
+    with open(source_path, 'r', encoding='utf-8') as f:
+        cells = json.load(f).get('cells', [])
+    tests = {}
+    for cell in cells:
+        info = cell.get('metadata', {}).get('nbgrader', {})
+        source = ''.join(cell['source']) if isinstance(cell.get('source'), list) else cell.get('source', '')
+        if info.get('grade', False) and not info.get('solution', False) and 'grade_id' in info \
+                and _TEST_CELL.search(source):
+            tests[info['grade_id']] = _declared_checks(source)
+    return tests
+
+def _notebook_cell_scores(notebook_path, tests=None):
+    """
+    Points earned per autograder test cell of one autograded notebook, {grade_id: points}, see _score_cell().
+    tests holds the declared checks of the cells with partial credit, see _source_tests(). Graded solution cells (manually
+    graded answers) are left out.
 
-    print(f'Course: {course_name} created succesfully with {len(users)} students.')
+    When ijson is installed the notebook is streamed: only the nbgrader metadata and the text outputs are looked at
+    and no other output (e.g. base64 images) is ever built in memory. Otherwise the whole notebook is loaded with json.
+    """
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+    tests = tests or {}
+    grades = {}
+    if ijson is None:
+        with open(notebook_path, 'r', encoding='utf-8') as f:
+            notebook_data = json.load(f)
+
+        def text(value):
+            return ''.join(value) if isinstance(value, list) else value or ''
+
+        for cell in notebook_data.get("cells", []):
+            nbgrader_info = cell.get("metadata", {}).get("nbgrader", {})
+            if nbgrader_info.get("grade", False) and not nbgrader_info.get("solution", False):
+                grade_id = nbgrader_info.get("grade_id", None)
+                if grade_id is not None:
+                    outputs = [{'output_type': o.get('output_type'), 'name': o.get('name'),
+                                'plain': text(o.get('data', {}).get('text/plain')),
+                                'tests': o.get('data', {}).get(TEST_RESULT_MIME)}
+                               for o in cell.get("outputs", [])]
+                    grades[grade_id] = _score_cell(float(nbgrader_info.get("points", 0)), outputs,
+                                                   tests.get(grade_id))
+        return grades
+
+    result_prefix = f'cells.item.outputs.item.data.{TEST_RESULT_MIME}'
+    cell = check = None
+    with open(notebook_path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if not prefix.startswith('cells.item'):
+                continue
+            if prefix == 'cells.item':
+                if event == 'start_map':
+                    cell = {'grade': False, 'solution': False, 'grade_id': None, 'points': 0, 'outputs': []}
+                elif event == 'end_map' and cell['grade'] and not cell['solution'] and cell['grade_id'] is not None:
+                    grades[cell['grade_id']] = _score_cell(float(cell['points']), cell['outputs'],
+                                                           tests.get(cell['grade_id']))
+            elif prefix.startswith('cells.item.metadata.nbgrader.'):
+                key = prefix[len('cells.item.metadata.nbgrader.'):]
+                if key in ('grade', 'solution', 'grade_id', 'points'):
+                    cell[key] = value
+            elif prefix == 'cells.item.outputs.item' and event == 'start_map':
+                cell['outputs'].append({'output_type': None, 'name': None, 'plain': '', 'tests': None})
+            elif prefix in ('cells.item.outputs.item.output_type', 'cells.item.outputs.item.name'):
+                cell['outputs'][-1][prefix.rsplit('.', 1)[1]] = value
+            elif prefix == result_prefix:
+                if event == 'start_map':
+                    cell['outputs'][-1]['tests'] = {}
+                elif event == 'map_key':
+                    check = value
+            elif prefix == f'{result_prefix}.{check}' and event in ('boolean', 'number', 'string', 'null'):
+                cell['outputs'][-1]['tests'][check] = value
+            elif (prefix in ('cells.item.outputs.item.data.text/plain', 'cells.item.outputs.item.data.text/plain.item')
+                  and event == 'string'):
+                cell['outputs'][-1]['plain'] += value
+    return grades
 
 def calculate_grades(aname, user, coursename, opath):
     """
     Calculate the points earned per graded cell from the notebook dictionary.
     
-    For each cell with nbgrader metadata, the function checks whether the cell passed its tests.
-    If the cell passed (determined by the lack of errors in its outputs), the full points are awarded.
-    Otherwise, no points (0) are given.
+    For each autograder test cell, the function scores its outputs with _score_cell(): partial credit
+    from the declared checks of the test (for cells with a TESTS line in the source notebook), otherwise full
+    points unless the cell raised an error.
     
     The result is returned in a dictionary where:
       - Each key is the cell's 'grade_id' (e.g., '1a', '1b', etc.) and its value is the points earned.
       - There is an extra key 'total' that contains the sum of all earned points.
     
     Parameters:
-        notebook_data (dict): The notebook's data structure.
+        aname (str): assignment name.
+        user (str): student username.
+        coursename (str): name of the course folder.
+        opath (str): overhead path that houses the course.
     
     Returns:
         dict: A dictionary of scores by cell id, along with 'total' earned points.
     """
     autograded_assignment_path = os.path.join(opath,coursename,'autograded',user,aname,f'{aname}.ipynb')
-    with open(autograded_assignment_path, 'r', encoding='utf-8') as f:
-        notebook_content = f.read()
-    notebook_data = json.loads(notebook_content)
-    
-    grades = {}
-    total_earned = 0
-    
-    # Iterate over each cell in the notebook.
-    for cell in notebook_data.get("cells", []):
-        nbgrader_info = cell.get("metadata", {}).get("nbgrader", {})
-        if nbgrader_info.get("grade", False):
-            grade_id = nbgrader_info.get("grade_id", None)
-            points = nbgrader_info.get("points", 0)
-            # Default earned points: 0 if the cell has errors, otherwise full points.
-            earned_points = 0
-            
-            # Determine if the cell passed its hidden tests:
-            # If there are no outputs, assume it passed.
-            # Otherwise, check that none of the outputs indicate an error.
-            outputs = cell.get("outputs", [])
-            if not outputs:
-                earned_points = points
-            else:
-                has_error = any(output.get("output_type") == "error" for output in outputs)
-                if not has_error:
-                    earned_points = points
-            
-            # If a valid grade_id exists, record the earned points.
-            if grade_id is not None:
-                grades[grade_id] = earned_points
-                total_earned += earned_points
-
-    grades["total"] = total_earned
+    grades = _notebook_cell_scores(autograded_assignment_path, _source_tests(os.path.join(opath,coursename), aname))
+    grades["total"] = sum(grades.values())
     return grades
 
-def autogradeAssignment(aname, coursename, opath=os.getcwd()):
+def _source_points(coursepath, aname):
+    """
+    {grade_id: points} of the graded cells in source/aname/aname.ipynb, in notebook order.
+    """
+    source_path = os.path.join(coursepath, 'source', aname, f'{aname}.ipynb')
+    if not os.path.exists(source_path):
+        return {}
+    with open(source_path, 'r', encoding='utf-8') as f:
+        cells = json.load(f).get('cells', [])
+    nbgrader_info = [cell.get('metadata', {}).get('nbgrader', {}) for cell in cells]
+    return {info['grade_id']: float(info.get('points', 0)) for info in nbgrader_info
+            if info.get('grade', False) and 'grade_id' in info}
+
+def _source_grade_ids(coursepath, aname):
+    """
+    grade_ids of the graded cells in source/aname/aname.ipynb, in notebook order.
+    """
+    return list(_source_points(coursepath, aname))
+
+def questionScores(aname, coursename, users=None, opath=os.getcwd()):
+    """
+    Points earned per question by every student, as a students x grade_ids matrix.
+
+    The scores of all students are read with one query on the course gradebook.db (the same scores nbgrader
+    exports, including manual grades and extra credit). Students that are missing from the database but have an
+    autograded notebook are read from the notebook instead, see calculate_grades().
+
+    -------------------------
+    Inputs
+    -------------------------
+    aname (str) : assignment name (not including extension).
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    users (list) : usernames to include. Default is every student with a score or an autograded notebook.
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame indexed by student_id with one float column per grade_id, in notebook order. Use .to_numpy()
+    for the plain NumPy matrix.
+    """
+    import sqlite3
+    import pandas as pd
+
+    coursepath = os.path.join(opath, coursename)
+    dbpath = os.path.join(coursepath, 'gradebook.db')
+    query = """
+        SELECT sa.student_id, bc.name AS grade_id,
+               COALESCE(g.manual_score, g.auto_score, 0) + COALESCE(g.extra_credit, 0) AS score
+        FROM grade g
+        JOIN submitted_notebook sn ON g.notebook_id = sn.id
+        JOIN submitted_assignment sa ON sn.assignment_id = sa.id
+        JOIN assignment a ON sa.assignment_id = a.id
+        JOIN base_cell bc ON g.cell_id = bc.id
+        JOIN grade_cells gc ON gc.id = bc.id
+        WHERE a.name = ?
+    """
+    try:
+        con = sqlite3.connect(f'file:{dbpath}?mode=ro', uri=True)
+        try:
+            long_scores = pd.read_sql_query(query, con, params=(aname,))
+        finally:
+            con.close()
+    except (sqlite3.Error, pd.errors.DatabaseError) as e:
+        print(f'Could not read scores from {dbpath} ({e}), reading the autograded notebooks instead.')
+        long_scores = pd.DataFrame(columns=['student_id', 'grade_id', 'score'])
+
+    autograded = os.path.join(coursepath, 'autograded')
+    if users is None:
+        on_disk = os.listdir(autograded) if os.path.exists(autograded) else []
+        users = sorted(set(long_scores['student_id']) | set(u for u in on_disk if os.path.exists(
+            os.path.join(autograded, u, aname, f'{aname}.ipynb'))))
+    long_scores = long_scores[long_scores['student_id'].isin(users)]
+
+    # Fall back to the notebooks for anyone the database does not know about
+    rows = [long_scores]
+    tests = _source_tests(coursepath, aname)
+    for user in set(users) - set(long_scores['student_id']):
+        notebook_path = os.path.join(autograded, user, aname, f'{aname}.ipynb')
+        if os.path.exists(notebook_path):
+            grades = _notebook_cell_scores(notebook_path, tests)
+            rows.append(pd.DataFrame({'student_id': user, 'grade_id': list(grades), 'score': list(grades.values())}))
+    long_scores = pd.concat(rows, ignore_index=True)
+
+    matrix = long_scores.pivot_table(index='student_id', columns='grade_id', values='score', aggfunc='sum')
+    order = [q for q in _source_grade_ids(coursepath, aname) if q in matrix.columns]
+    order += sorted(q for q in matrix.columns if q not in order)
+    matrix = matrix.reindex(index=[u for u in users if u in matrix.index], columns=order).astype(float)
+    matrix.columns.name = None
+    return matrix
+
+def scoreNotebooks(aname, coursename, users=None, opath=os.getcwd(), write=True):
+    """
+    Scores the autograder test cells of autograded notebooks with the partial credit rules of _score_cell() and
+    writes the scores into gradebook.db as nbgrader's auto_score. Run after autograding and before feedback, so the
+    gradebook, the feedback, the plots and the uploaded Blackboard scores all use the same scores.
+
+    A test cell earns partial credit when its cell in the source notebook has a "# TESTS" line, checks with literal
+    names (and weights) and ends by displaying the results as TEST_RESULT_MIME, e.g.
+        # TESTS
+        results = {}
+        def check(name, test, weight=1):
+            try:
+                results[name] = bool(test())
+            except Exception:
+                results[name] = False
+        check('add(1, 2)', lambda: add(1, 2) == 3)
+        check('add(2, 2)', lambda: add(2, 2) == 4, 2)
+        display({TEST_RESULT_MIME: results, 'text/plain': str(results)}, raw=True)
+    Names and weights come from the source notebook and only the last output of the cell is read, see
+    _score_cell(). Student code runs inside the checks, before that output, so results it displays itself are
+    ignored. Like any test it still runs in the same kernel, so code that tampers with the kernel itself (e.g.
+    replaces display) is not stopped. Cells without a TESTS line are scored all-or-nothing like nbgrader does.
+
+    -------------------------
+    Inputs
+    -------------------------
+    aname (str) : assignment name (not including extension).
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    users (list) : students to score. Default is every student with an autograded notebook.
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    write (bool) : store the scores in gradebook.db. Manual scores and extra credit are left alone.
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame indexed by student_id with one float column per test cell, see questionScores().
+    """
+    import sqlite3
+    import pandas as pd
+
+    coursepath = os.path.join(opath, coursename)
+    autograded = os.path.join(coursepath, 'autograded')
+    if users is None:
+        users = sorted(os.listdir(autograded)) if os.path.exists(autograded) else []
+    paths = {u: os.path.join(autograded, u, aname, f'{aname}.ipynb') for u in users}
+    tests = _source_tests(coursepath, aname)
+    scores = {u: _notebook_cell_scores(path, tests) for u, path in paths.items() if os.path.exists(path)}
+
+    matrix = pd.DataFrame.from_dict(scores, orient='index', dtype=float)
+    order = [q for q in _source_grade_ids(coursepath, aname) if q in matrix.columns]
+    matrix = matrix.reindex(columns=order + sorted(q for q in matrix.columns if q not in order))
+    matrix.index.name = 'student_id'
+
+    if write and scores:
+        con = sqlite3.connect(os.path.join(coursepath, 'gradebook.db'), timeout=30)
+        try:
+            ids = con.execute("""
+                SELECT g.id, sa.student_id, bc.name
+                FROM grade g
+                JOIN submitted_notebook sn ON g.notebook_id = sn.id
+                JOIN submitted_assignment sa ON sn.assignment_id = sa.id
+                JOIN assignment a ON sa.assignment_id = a.id
+                JOIN base_cell bc ON g.cell_id = bc.id
+                WHERE a.name = ?
+            """, (aname,)).fetchall()
+            updates = [(scores[user][grade_id], id_) for id_, user, grade_id in ids
+                       if grade_id in scores.get(user, {})]
+            with con:
+                con.executemany('UPDATE grade SET auto_score = ? WHERE id = ?', updates)
+        finally:
+            con.close()
+    return matrix
+
+def _stream_hash(f, dst=None):
+    """
+    SHA-256 of an open binary file (or zip member), read in chunks so large notebooks are not loaded into memory at once.
+    The chunks are also written to the open binary file dst if given, so a zip member is decompressed only once.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        digest.update(chunk)
+        if dst is not None:
+            dst.write(chunk)
+    return digest.hexdigest()
+
+def _file_hash(path):
+    with open(path, 'rb') as f:
+        return _stream_hash(f)
+
+def _load_manifest(assignment_scratch):
+    """
+    Reads scratch/aname/manifest.json, the record of the source notebook hash and of every student's
+    submitted notebook hash from the last grading run.
+    """
+    manifest_path = os.path.join(assignment_scratch, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return {'source': None, 'submissions': {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def _save_manifest(assignment_scratch, manifest):
+    manifest_path = os.path.join(assignment_scratch, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def _cpu_seconds():
+    """
+    User plus system CPU time of this process and of every child process that has finished so far. Without the
+    resource module (Windows) only this process is counted.
+    """
+    try:
+        import resource
+    except ImportError:
+        return time.process_time()
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+def _peak_rss_mb(children=False):
+    """
+    High-water mark of the resident memory in MB of this process, or of its largest finished child. NaN without the
+    resource module (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss / 1024
+
+@contextlib.contextmanager
+def _timed(timings, stage):
+    """
+    Appends the wall time, CPU time (see _cpu_seconds()) and memory of a grading stage to the list timings.
+    rss_growth_mb is how much the stage raised the peak resident memory of this process (0 if it stayed below an
+    earlier peak). max_rss_mb and max_child_rss_mb are the running high-water marks at the end of the stage of this
+    process and of its largest finished child (e.g. a kernel), not of the stage alone.
+    """
+    wall, cpu, rss = time.perf_counter(), _cpu_seconds(), _peak_rss_mb()
+    try:
+        yield
+    finally:
+        max_rss = _peak_rss_mb()
+        timings.append({'stage': stage, 'wall_seconds': time.perf_counter() - wall, 'cpu_seconds': _cpu_seconds() - cpu,
+                        'rss_growth_mb': max_rss - rss, 'max_rss_mb': max_rss,
+                        'max_child_rss_mb': _peak_rss_mb(children=True)})
+
+def _write_run_report(report_dir, timings, notebooks=None, name='run_report'):
+    """
+    Saves the stage timings (and the per-notebook rows of a pool run) as name.json and name.csv in report_dir and
+    prints them. Notebooks that took more than three times the median wall time are flagged as slow.
+    """
+    import pandas as pd
+
+    stages = pd.DataFrame(timings, columns=['stage', 'wall_seconds', 'cpu_seconds', 'rss_growth_mb', 'max_rss_mb',
+                                           'max_child_rss_mb'])
+    stages.to_csv(os.path.join(report_dir, f'{name}.csv'), index=False)
+    report = {'stages': stages.to_dict('records'), 'notebooks': [], 'slowest': []}
+
+    print('------------------------------------------------------------------------------------------')
+    print(stages.to_string(index=False, float_format='%.1f'))
+    if notebooks is not None and len(notebooks):
+        slow = notebooks[notebooks['slow']].sort_values('seconds', ascending=False)
+        report['notebooks'] = notebooks.to_dict('records')
+        report['slowest'] = slow.to_dict('records')
+        if len(slow):
+            print(f"\n🐢 {len(slow)} notebooks took more than 3x the median time ({notebooks['seconds'].median():.1f} s):")
+            print(slow[['assignment', 'student_id', 'status', 'seconds', 'cpu_seconds', 'peak_rss_mb']].to_string(
+                index=False, float_format='%.1f'))
+    with open(os.path.join(report_dir, f'{name}.json'), 'w') as f:
+        json.dump(report, f, indent=1, default=str)
+
+# Statuses of a notebook that was stopped by one of the limits of _run_nbgrader()
+_LIMIT_STATUSES = ['timeout', 'cpu_limit', 'memory_limit']
+
+# Run as `python -c _RLIMIT_EXEC CPU_LIMIT MEMORY_LIMIT command...`: sets the limits, then replaces itself with the
+# command. Limits are per process and inherited, so nbgrader and the kernel it launches each get CPU_LIMIT CPU seconds
+# (SIGXCPU, then SIGKILL a second later) and MEMORY_LIMIT MB of address space (allocations beyond it raise
+# MemoryError). An empty limit is not set. Unlike Popen's preexec_fn this is safe while other threads are running.
+_RLIMIT_EXEC = """
+import os, resource, sys
+cpu_limit, memory_limit = sys.argv[1:3]
+if cpu_limit:
+    resource.setrlimit(resource.RLIMIT_CPU, (int(cpu_limit), int(cpu_limit) + 1))
+if memory_limit:
+    nbytes = int(float(memory_limit) * 1024**2)
+    resource.setrlimit(resource.RLIMIT_AS, (nbytes, nbytes))
+os.execvp(sys.argv[3], sys.argv[3:])
+"""
+
+def _memory_errors(autograded_path):
+    """
+    True if any cell of the autograded notebooks in autograded_path raised a MemoryError. Under a memory limit the
+    error is raised inside the student's cell, so nbgrader itself still finishes normally.
+    """
+    for name in os.listdir(autograded_path):
+        if name.endswith('.ipynb'):
+            with open(os.path.join(autograded_path, name), 'r') as f:
+                cells = json.load(f).get('cells', [])
+            if any(out.get('ename') == 'MemoryError' for cell in cells for out in cell.get('outputs', [])):
+                return True
+    return False
+
+def _run_nbgrader(args, cwd, timeout=None, cpu_limit=None, memory_limit=None, stop=None):
+    """
+    Runs an nbgrader command in its own process group so that a timeout also kills it, after which the kernel
+    it started shuts itself down. cpu_limit (CPU seconds) and memory_limit (MB) are applied as rlimits to nbgrader
+    and its kernel, see _RLIMIT_EXEC. Setting the threading.Event stop kills it as well. Returns (status, message,
+    usage) where status is 'graded', 'failed', 'timeout', 'cpu_limit', 'memory_limit' or 'cancelled' and usage
+    holds the CPU seconds and peak RSS of nbgrader and the kernel it ran. Without os.wait4 (Windows) nbgrader is run
+    as a plain subprocess without rlimits, and usage is NaN.
+    """
+    import sys
+
+    unix = hasattr(os, 'wait4')
+    if not unix and (cpu_limit is not None or memory_limit is not None):
+        raise RuntimeError('cpu_limit and memory_limit need a Unix system, on Windows only a timeout can be used.')
+    env = None
+    if memory_limit is not None:
+        # Every BLAS thread reserves its own buffers, which counts against the address space limit
+        env = dict(os.environ, OMP_NUM_THREADS='1', OPENBLAS_NUM_THREADS='1', MKL_NUM_THREADS='1')
+    command = ["nbgrader"] + args
+    if cpu_limit is not None or memory_limit is not None:
+        command = [sys.executable, '-c', _RLIMIT_EXEC, '' if cpu_limit is None else str(cpu_limit),
+                   '' if memory_limit is None else str(memory_limit)] + command
+
+    with tempfile.TemporaryFile(mode='w+') as log:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        timed_out = cancelled = False
+        if not unix:
+            # Windows has no process groups or rusage. The kernel exits by itself when nbgrader is killed.
+            proc = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT, text=True, env=env)
+            while proc.poll() is None:
+                timed_out = deadline is not None and time.monotonic() > deadline
+                cancelled = stop is not None and stop.is_set()
+                if timed_out or cancelled:
+                    proc.kill()
+                    proc.wait()
+                    break
+                time.sleep(0.05)
+            usage = {'cpu_seconds': float('nan'), 'peak_rss_mb': float('nan')}
+        else:
+            proc = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT, text=True,
+                                    start_new_session=True, env=env)
+
+            # os.wait4 instead of Popen.wait so the resource usage of the finished process can be read
+            pid, waitstatus, rusage = os.wait4(proc.pid, os.WNOHANG)
+            while not pid:
+                timed_out = deadline is not None and time.monotonic() > deadline
+                cancelled = stop is not None and stop.is_set()
+                if timed_out or cancelled:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    pid, waitstatus, rusage = os.wait4(proc.pid, 0)
+                    break
+                time.sleep(0.05)
+                pid, waitstatus, rusage = os.wait4(proc.pid, os.WNOHANG)
+            proc.returncode = os.waitstatus_to_exitcode(waitstatus)
+            usage = {'cpu_seconds': rusage.ru_utime + rusage.ru_stime, 'peak_rss_mb': rusage.ru_maxrss / 1024}
+
+        if cancelled:
+            return 'cancelled', 'grading was cancelled', usage
+        if timed_out:
+            return 'timeout', f'exceeded {timeout} s', usage
+        if proc.returncode != 0:
+            log.seek(0)
+            lines = [l for l in log.read().splitlines() if l.strip()]
+            errors = [l.strip() for l in lines if re.match(r'\s*[\w.]*(Error|Exception):', l)]
+            if cpu_limit is not None and (-proc.returncode in (signal.SIGXCPU, signal.SIGKILL)
+                                          or any('DeadKernelError' in l for l in errors)):
+                return 'cpu_limit', f'kernel killed after the {cpu_limit} s CPU limit', usage
+            if memory_limit is not None and any('MemoryError' in l for l in errors):
+                return 'memory_limit', f'exceeded the {memory_limit} MB memory limit', usage
+            if errors:
+                return 'failed', errors[-1], usage
+            return 'failed', lines[-1] if lines else f'exit code {proc.returncode}', usage
+    return 'graded', '', usage
+
+def _autograde_one(workpath, aname, user, limits, stop=None):
+    """
+    Autogrades one student with its own nbgrader call inside the private course copy at workpath and records the
+    wall-clock time, CPU time and peak RSS of the notebook. limits holds the timeout, cpu_limit and memory_limit
+    passed to _run_nbgrader().
+    """
+    workpath = os.path.abspath(workpath)
+    dburl = 'sqlite:///' + os.path.join(workpath, 'gradebook.db')
+    start = time.perf_counter()
+    status, message, usage = _run_nbgrader(["autograde", aname, "--student", user, "--force",
+                                            f"--CourseDirectory.root={workpath}",
+                                            f"--CourseDirectory.db_url={dburl}"], workpath, stop=stop, **limits)
+    if (status == 'graded' and limits['memory_limit'] is not None
+            and _memory_errors(os.path.join(workpath, 'autograded', user, aname))):
+        status, message = 'memory_limit', f"exceeded the {limits['memory_limit']} MB memory limit"
+    return dict({'assignment': aname, 'student_id': user, 'status': status,
+                 'seconds': time.perf_counter() - start, 'message': message}, **usage)
+
+def _autograde_shard(workpath, tasks, limits):
+    """
+    Worker run inside the process pool. Autogrades each (aname, user) task of a shard, see _autograde_one().
+    """
+    return [_autograde_one(workpath, aname, user, limits) for aname, user in tasks]
+
+# Modules every warm kernel imports before it is handed a notebook (missing ones are skipped). The names are removed
+# again with %reset, so a student who forgets an import still gets a NameError, only the import itself is cached.
+WARM_PRELOAD = ['numpy', 'pandas', 'scipy', 'matplotlib.pyplot']
+
+class _KernelPool:
+    """
+    Pre-started python3 kernels of one worker process, each with WARM_PRELOAD already imported.
+
+    isolation 'restart' runs every notebook in a kernel of its own: a used kernel is shut down and replaced by a new
+    one that boots and imports while the next notebooks run. 'reset' reuses a kernel for up to max_uses notebooks and
+    clears its namespace with %reset in between. That is faster, but imported modules (and anything a student changed
+    inside them, e.g. a random seed or matplotlib settings) carry over to the next student.
+    """
+    def __init__(self, size=2, isolation='restart', max_uses=20):
+        assert isolation in ('restart', 'reset'), "isolation must be 'restart' or 'reset'"
+        self.isolation = isolation
+        self.max_uses = max_uses
+        self.preload = (f'for _name in {WARM_PRELOAD!r}:\n'
+                        '    try:\n        __import__(_name)\n    except ImportError:\n        pass\n'
+                        '%reset -f')
+        self.ready = [self._start() for _ in range(max(1, size))]
+
+    def _start(self):
+        from jupyter_client.manager import AsyncKernelManager
+        from jupyter_core.utils import run_sync
+
+        km = AsyncKernelManager(kernel_name='python3')
+        run_sync(km.start_kernel)(extra_arguments=['--HistoryManager.hist_file=:memory:'])
+        kc = km.blocking_client()
+        kc.start_channels()
+        # Queued until the kernel is up, so it boots and imports in the background
+        return {'km': km, 'kc': kc, 'pending': kc.execute(self.preload, silent=True, store_history=False), 'uses': 0}
+
+    def _wait(self, kernel, timeout=120):
+        while True:
+            reply = kernel['kc'].get_shell_msg(timeout=timeout)
+            if reply['parent_header'].get('msg_id') == kernel['pending']:
+                return reply
+
+    def _stop(self, kernel):
+        from jupyter_core.utils import run_sync
+
+        kernel['kc'].stop_channels()
+        run_sync(kernel['km'].shutdown_kernel)(now=True)
+
+    def acquire(self, cwd):
+        """
+        Next ready kernel, with its working directory set to cwd (the folder of the notebook).
+        """
+        kernel = self.ready.pop(0)
+        self._wait(kernel)
+        kernel['pending'] = kernel['kc'].execute(f'import os as _os; _os.chdir({cwd!r}); del _os', silent=True,
+                                                 store_history=False)
+        self._wait(kernel)
+        return kernel
+
+    def release(self, kernel):
+        from jupyter_core.utils import run_sync
+
+        kernel['uses'] += 1
+        if self.isolation == 'restart' or kernel['uses'] >= self.max_uses or not run_sync(kernel['km'].is_alive)():
+            self._stop(kernel)
+            kernel = self._start()
+        else:
+            kernel['pending'] = kernel['kc'].execute('%reset -f', silent=True, store_history=False)
+        self.ready.append(kernel)
+
+    def close(self):
+        for kernel in self.ready:
+            self._stop(kernel)
+        self.ready = []
+
+def _warm_execute(pool):
+    """
+    nbgrader's Execute preprocessor, but the notebook runs in a kernel borrowed from pool instead of a new one.
+    Execute settings from nbgrader_config.py (e.g. c.Execute.timeout) still apply.
+    """
+    from nbgrader.preprocessors import Execute
+
+    class WarmExecute(Execute):
+        def preprocess(self, nb, resources=None, km=None):
+            kernel = pool.acquire(resources.get('metadata', {}).get('path') or os.getcwd())
+            try:
+                return super().preprocess(nb, resources, km=kernel['km'])
+            finally:
+                # The client is only cleaned up by nbclient when it owns the kernel
+                if self.kc is not None:
+                    self.kc.stop_channels()
+                    self.kc = None
+                pool.release(kernel)
+    return WarmExecute
+
+def _autograde_shard_warm(workpath, tasks, warm):
+    """
+    Warm-kernel version of _autograde_shard(). nbgrader is imported once per worker and runs in-process, with its
+    Execute preprocessor taking kernels from a _KernelPool of warm['kernels'] kernels under warm['isolation'].
+    cpu_seconds is approximate, a kernel's CPU time is only counted once it has been shut down.
+    """
+    from nbgrader.converters import Autograde
+    from nbgrader.coursedir import CourseDirectory
+    from nbgrader.preprocessors import Execute
+    from nbgrader.utils import capture_log
+    from traitlets.config.loader import PyFileConfigLoader
+
+    config = PyFileConfigLoader('nbgrader_config.py', path=workpath).load_config()
+    config.CourseDirectory.root = workpath
+    config.CourseDirectory.db_url = 'sqlite:///' + os.path.join(workpath, 'gradebook.db')
+    pool = _KernelPool(warm['kernels'], warm['isolation'])
+    preprocessors = config.Autograde.get('autograde_preprocessors',
+                                         Autograde.class_traits()['autograde_preprocessors'].default())
+    config.Autograde.autograde_preprocessors = [_warm_execute(pool) if pp is Execute else pp for pp in preprocessors]
+
+    results = []
+    try:
+        for aname, user in tasks:
+            start, cpu = time.perf_counter(), _cpu_seconds()
+            app = Autograde(coursedir=CourseDirectory(config=config, assignment_id=aname, student_id=user),
+                            config=config)
+            app.force = True
+            app.create_student = True
+            result = capture_log(app)
+            errors = [l for l in result.get('error', '').splitlines() if l.strip()]
+            results.append({'assignment': aname, 'student_id': user,
+                            'status': 'graded' if result['success'] else 'failed',
+                            'seconds': time.perf_counter() - start, 'message': errors[-1] if errors else '',
+                            'cpu_seconds': _cpu_seconds() - cpu,
+                            'peak_rss_mb': _peak_rss_mb()})
+    finally:
+        pool.close()
+    return results
+
+def _copy_shard(coursepath, workpath, tasks):
+    """
+    Creates an isolated course copy for one shard: config, gradebook.db, the source assignments and the
+    submissions of the shard's (aname, user) tasks only.
+    """
+    if os.path.exists(workpath):
+        shutil.rmtree(workpath)
+    os.makedirs(workpath)
+    shutil.copy2(os.path.join(coursepath, 'nbgrader_config.py'), workpath)
+    shutil.copy2(os.path.join(coursepath, 'gradebook.db'), workpath)
+    for aname in sorted(set(aname for aname, _ in tasks)):
+        shutil.copytree(os.path.join(coursepath, 'source', aname), os.path.join(workpath, 'source', aname))
+    for aname, user in tasks:
+        shutil.copytree(os.path.join(coursepath, 'submitted', user, aname),
+                        os.path.join(workpath, 'submitted', user, aname))
+
+def _merge_shard(coursepath, workpath, tasks):
+    """
+    Copies the autograded notebooks of a finished shard back into the course and writes their scores
+    into the course gradebook.db using nbgrader's Gradebook API. nbgrader's all-or-nothing scores are then replaced
+    by those of scoreNotebooks(), so every path that grades into gradebook.db leaves the same scores.
+    """
+    from nbgrader.api import Gradebook
+
+    coursename = os.path.basename(coursepath)
+    with Gradebook('sqlite:///' + os.path.join(workpath, 'gradebook.db'), coursename) as wgb, \
+         Gradebook('sqlite:///' + os.path.join(coursepath, 'gradebook.db'), coursename) as gb:
+        for aname, user in tasks:
+            src = os.path.join(workpath, 'autograded', user, aname)
+            dst = os.path.join(coursepath, 'autograded', user, aname)
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            shutil.copytree(src, dst)
+
+            wsub = wgb.find_submission(aname, user)
+            gb.update_or_create_student(user)
+            gb.update_or_create_submission(aname, user, timestamp=wsub.timestamp)
+            for wnb in wsub.notebooks:
+                nb = gb.find_submission_notebook(wnb.name, aname, user)
+                nb.late_submission_penalty = wnb.late_submission_penalty
+                for wgrade in wnb.grades:
+                    grade = gb.find_grade(wgrade.name, wnb.name, aname, user)
+                    grade.auto_score = wgrade.auto_score
+                    grade.needs_manual_grade = wgrade.needs_manual_grade
+                for wcomment in wnb.comments:
+                    comment = gb.find_comment(wcomment.name, wnb.name, aname, user)
+                    comment.auto_comment = wcomment.auto_comment
+            gb.db.commit()
+
+    for aname in sorted(set(aname for aname, _ in tasks)):
+        scoreNotebooks(aname, coursename, users=[user for a, user in tasks if a == aname],
+                       opath=os.path.dirname(coursepath))
+
+def _autograde_pool(coursepath, tasks, workroot, workers=None, timeout=None, cpu_limit=None, memory_limit=None,
+                    warm=None):
+    """
+    Runs (aname, user) autograde tasks, possibly from several assignments, through one process pool. Tasks are
+    split round-robin into one shard per worker, each shard is graded in its own course copy under workroot and
+    merged into the course as soon as it finishes. Only 'graded' notebooks are merged, notebooks stopped by a
+    limit are left out like any other failure. warm ({'kernels': n, 'isolation': ...}) grades the shards with
+    _autograde_shard_warm(), which cannot enforce the limits. Returns (results, workers used, elapsed seconds).
+    """
+    assert not warm or (timeout, cpu_limit, memory_limit) == (None, None, None), \
+        'Warm kernels cannot be combined with timeout, cpu_limit or memory_limit'
+    if not tasks:
+        return [], 0, 0.0
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks)))
+    shards = [tasks[i::workers] for i in range(workers)]
+
+    for i, shard in enumerate(shards):
+        _copy_shard(coursepath, os.path.join(workroot, f'shard_{i}'), shard)
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        limits = {'timeout': timeout, 'cpu_limit': cpu_limit, 'memory_limit': memory_limit}
+        shard_fn, options = (_autograde_shard_warm, warm) if warm else (_autograde_shard, limits)
+        futures = {pool.submit(shard_fn, os.path.join(workroot, f'shard_{i}'), shard, options): i
+                   for i, shard in enumerate(shards)}
+        for future in as_completed(futures):
+            i = futures[future]
+            shard_results = future.result()
+            for r in shard_results:
+                r['shard'] = i
+            graded = [(r['assignment'], r['student_id']) for r in shard_results if r['status'] == 'graded']
+            _merge_shard(coursepath, os.path.join(workroot, f'shard_{i}'), graded)
+            results.extend(shard_results)
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(workroot)
+    return results, workers, elapsed
+
+def _autograde_summary(results, workers, elapsed, csv_path):
+    """
+    Prints the per-student wall-clock summary of a pool run and saves it to csv_path.
+    """
+    import pandas as pd
+
+    summary = pd.DataFrame(results, columns=['assignment', 'student_id', 'status', 'seconds', 'cpu_seconds',
+                                             'peak_rss_mb', 'message', 'shard'])
+    summary = summary.sort_values('seconds', ascending=False)
+    summary['slow'] = summary['seconds'] > 3 * summary['seconds'].median()
+    summary.to_csv(csv_path, index=False)
+
+    print(f'Autograded {len(summary)} notebooks with {workers} workers in {elapsed:.1f} s')
+    print(summary[['assignment', 'student_id', 'status', 'seconds', 'cpu_seconds', 'peak_rss_mb']].to_string(
+        index=False, float_format='%.1f'))
+    for _, row in summary[summary['status'] != 'graded'].iterrows():
+        print(f"Student {row['student_id']} ({row['assignment']}) {row['status']}: {row['message']}")
+    hits = summary['status'].value_counts().reindex(_LIMIT_STATUSES, fill_value=0)
+    if hits.sum():
+        print(f"{hits.sum()} notebooks were stopped by a limit and not graded: "
+              + ', '.join(f'{n} {status}' for status, n in hits.items() if n))
+    return summary
+
+# nbgrader autograde logs this line when it starts on the next student
+_NBGRADER_STUDENT = re.compile(r"Creating/updating student with ID '([^']+)'")
+
+def _autograde_serial(coursepath, aname):
+    """
+    Runs a single `nbgrader autograde` over the class and times every notebook from the log line that starts it (the
+    log is still printed). A student without an autograded notebook afterwards is reported as failed. CPU time and
+    peak RSS are only known for nbgrader as a whole, so they are NaN. Returns the summary of _autograde_summary(),
+    which is also saved as scratch/aname/autograde_times.csv.
+    """
+    import sys
+
+    results = []
+    def finish(row, started):
+        row['seconds'] = time.perf_counter() - started
+        if not os.path.exists(os.path.join(coursepath, 'autograded', row['student_id'], aname, f'{aname}.ipynb')):
+            row['status'], row['message'] = 'failed', 'no autograded notebook, see the nbgrader log'
+
+    start = started = time.perf_counter()
+    proc = subprocess.Popen(["nbgrader", "autograde", aname], cwd=coursepath, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True)
+    for line in proc.stdout:
+        sys.stdout.write(line)
+        match = _NBGRADER_STUDENT.search(line)
+        if match:
+            if results:
+                finish(results[-1], started)
+            started = time.perf_counter()
+            results.append({'assignment': aname, 'student_id': match[1], 'status': 'graded', 'cpu_seconds': float('nan'),
+                            'peak_rss_mb': float('nan'), 'message': '', 'shard': 0})
+    proc.wait()
+    if results:
+        finish(results[-1], started)
+    return _autograde_summary(results, 1, time.perf_counter() - start,
+                              os.path.join(coursepath, 'scratch', aname, 'autograde_times.csv'))
+
+def parallelAutograde(aname, coursename, users=None, workers=None, timeout=None, opath=os.getcwd(), cpu_limit=None,
+                      memory_limit=None, warm_kernels=0, isolation='restart'):
+    """
+    Autogrades an assignment across a pool of worker processes instead of a single `nbgrader autograde` call.
+
+    The roster is split into one shard per worker. Every shard is graded in its own copy of the course under
+    scratch/aname/workers/ (so the workers never write to the same gradebook.db), one nbgrader call per student.
+    Once all shards finish, the autograded notebooks are copied into autograded/ and the scores are merged into
+    the course gradebook.db.
+
+    -------------------------
+    Inputs
+    -------------------------
+    aname (str) : assignment name (not including extension).
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    users (list) : student usernames to autograde. Default is every student with a submitted/user/aname folder.
+    workers (int) : number of worker processes. Default is the number of CPUs.
+    timeout (float) : wall-clock limit in seconds for each student's notebook. A notebook that runs longer is
+                      killed and reported as 'timeout'. Default is no limit.
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    cpu_limit (int) : CPU seconds each student's kernel may use (an rlimit, nbgrader gets its own as well, so leave
+                      it room to start: at least ~15 s). A kernel that uses more is killed and reported as 'cpu_limit'.
+    memory_limit (float) : address space limit in MB for each student's kernel and for nbgrader itself (at least
+                           ~1024). A notebook whose cells raise MemoryError is reported as 'memory_limit'.
+    warm_kernels (int) : number of kernels each worker keeps started with WARM_PRELOAD imported. Default 0 starts a
+                         new kernel (and nbgrader) for every notebook. Warm kernels run nbgrader in-process and do
+                         not support timeout, cpu_limit or memory_limit; see benchmarkWarmKernels() for the gain.
+    isolation (str) : 'restart' (default) gives every notebook a fresh kernel, 'reset' reuses a kernel for up to
+                      20 notebooks and only clears its namespace in between, see _KernelPool.
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per student: assignment, student_id, status ('graded', 'failed', 'timeout',
+    'cpu_limit' or 'memory_limit'), seconds (wall-clock time of the notebook), cpu_seconds and peak_rss_mb (of
+    nbgrader and the kernel), message (the reason a notebook failed), shard and slow (more than 3x the median
+    time). It is also saved as scratch/aname/autograde_times.csv.
+    """
+    coursepath = os.path.join(opath, coursename)
+    subpath = os.path.join(coursepath, 'submitted')
+    assignment_scratch = os.path.join(coursepath, 'scratch', aname)
+
+    if users is None:
+        users = sorted(u for u in os.listdir(subpath) if os.path.exists(os.path.join(subpath, u, aname)))
+    tasks = [(aname, user) for user in users]
+    warm = {'kernels': warm_kernels, 'isolation': isolation} if warm_kernels else None
+    results, workers, elapsed = _autograde_pool(coursepath, tasks, os.path.join(assignment_scratch, 'workers'),
+                                                workers, timeout, cpu_limit, memory_limit, warm)
+    return _autograde_summary(results, workers, elapsed, os.path.join(assignment_scratch, 'autograde_times.csv'))
+
+def benchmarkWarmKernels(aname, coursename, users=None, workers=1, warm_kernels=2, isolation='restart',
+                         opath=os.getcwd()):
+    """
+    Times autograding the same submissions with a new kernel per notebook (the default) and with warm kernels, and
+    checks that both give the same per-question scores. Both runs write their results into the course like
+    parallelAutograde(), so run it on an assignment that has already been autograded.
+
+    -------------------------
+    Inputs
+    -------------------------
+    aname (str) : assignment name (not including extension).
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    users (list) : student usernames to autograde. Default is every student with a submitted/user/aname folder.
+    workers (int) : number of worker processes for both runs.
+    warm_kernels (int), isolation (str) : warm kernel settings, see parallelAutograde().
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per mode ('cold', 'warm'): workers, notebooks, graded, seconds, notebooks_per_minute
+    and speedup over cold. It is also saved as scratch/aname/warm_benchmark.csv.
+    """
+    import pandas as pd
+
+    coursepath = os.path.join(opath, coursename)
+    subpath = os.path.join(coursepath, 'submitted')
+    assignment_scratch = os.path.join(coursepath, 'scratch', aname)
+
+    if users is None:
+        users = sorted(u for u in os.listdir(subpath) if os.path.exists(os.path.join(subpath, u, aname)))
+    tasks = [(aname, user) for user in users]
+
+    rows = []
+    scores = {}
+    for mode, warm in [('cold', None), ('warm', {'kernels': warm_kernels, 'isolation': isolation})]:
+        results, used, elapsed = _autograde_pool(coursepath, tasks, os.path.join(assignment_scratch, 'benchmark'),
+                                                 workers, warm=warm)
+        rows.append({'mode': mode, 'workers': used, 'notebooks': len(results),
+                     'graded': sum(r['status'] == 'graded' for r in results), 'seconds': elapsed,
+                     'notebooks_per_minute': 60 * len(results) / elapsed if elapsed else 0.0})
+        scores[mode] = questionScores(aname, coursename, users=users, opath=opath)
+
+    benchmark = pd.DataFrame(rows)
+    benchmark['speedup'] = benchmark['seconds'].iloc[0] / benchmark['seconds']
+    benchmark.to_csv(os.path.join(assignment_scratch, 'warm_benchmark.csv'), index=False)
+
+    print('------------------------------------------------------------------------------------------')
+    print(benchmark.to_string(index=False, float_format='%.2f'))
+    if scores['cold'].equals(scores['warm']):
+        print('Cold and warm kernels gave the same scores.')
+    else:
+        print('⚠️ Cold and warm kernels gave different scores, check the isolation setting.')
+    return benchmark
+
+_QUEUE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tasks (
+        job TEXT NOT NULL, assignment TEXT NOT NULL, student_id TEXT NOT NULL, notebook_hash TEXT,
+        status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, worker INTEGER, seconds REAL, cpu_seconds REAL,
+        peak_rss_mb REAL, message TEXT, started_at REAL, finished_at REAL,
+        PRIMARY KEY (job, assignment, student_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS tasks_status ON tasks (job, status);
+    CREATE TABLE IF NOT EXISTS jobs (job TEXT PRIMARY KEY, workers INTEGER, run_started REAL, run_finished REAL);
+"""
+
+def _queue_connect(coursepath):
+    """
+    Opens the persistent job queue coursepath/scratch/queue.db, see queueAutograde().
+    """
+    import sqlite3
+
+    os.makedirs(os.path.join(coursepath, 'scratch'), exist_ok=True)
+    con = sqlite3.connect(os.path.join(coursepath, 'scratch', 'queue.db'), timeout=30)
+    con.executescript(_QUEUE_SCHEMA)
+    return con
+
+def queueAutograde(aname, coursename, users=None, opath=os.getcwd(), job=None, requeue=False):
+    """
+    Puts one autograde task per student on the persistent job queue of the course (scratch/queue.db), to be run by
+    runQueue(). A student who is already graded is only queued again when the source or submitted notebook changed,
+    so queueing the same class twice does not regrade it. Students whose last task failed or hit a limit are always
+    queued again.
+
+    -------------------------
+    Inputs
+    -------------------------
+    aname (str) : assignment name (not including extension).
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    users (list) : student usernames to queue. Default is every student with a submitted/user/aname notebook.
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    job (str) : name of the job, default aname. Several assignments can be queued under one job.
+    requeue (bool) : queue graded students again even if their notebooks did not change.
+
+    -------------------------
+    Outputs
+    -------------------------
+    Number of pending tasks of the job.
+    """
+    coursepath = os.path.join(opath, coursename)
+    subpath = os.path.join(coursepath, 'submitted')
+    job = job or aname
+    if users is None:
+        users = sorted(u for u in os.listdir(subpath)
+                       if os.path.exists(os.path.join(subpath, u, aname, f'{aname}.ipynb')))
+
+    # The key of a task changes with the source notebook as well as with the submission
+    source_hash = _file_hash(os.path.join(coursepath, 'source', aname, f'{aname}.ipynb'))[:16]
+    rows = [(job, aname, user, f"{source_hash}_{_file_hash(os.path.join(subpath, user, aname, f'{aname}.ipynb'))[:16]}",
+             int(requeue)) for user in users]
+    con = _queue_connect(coursepath)
+    try:
+        with con:
+            con.executemany("""
+                INSERT INTO tasks (job, assignment, student_id, notebook_hash, status) VALUES (?, ?, ?, ?, 'pending')
+                ON CONFLICT (job, assignment, student_id) DO UPDATE
+                SET notebook_hash = excluded.notebook_hash, status = 'pending', attempts = 0
+                WHERE tasks.notebook_hash IS NOT excluded.notebook_hash OR tasks.status != 'graded' OR ?
+            """, rows)
+        pending = con.execute("SELECT COUNT(*) FROM tasks WHERE job = ? AND status = 'pending'", (job,)).fetchone()[0]
+    finally:
+        con.close()
+    print(f'{pending} notebooks pending in job {job}.')
+    return pending
+
+def gradingProgress(coursename, job, opath=os.getcwd()):
+    """
+    Progress of a queued grading job (see runQueue()). It is read from scratch/queue.db, so it can be polled from
+    another cell, kernel or terminal while the job runs.
+
+    -------------------------
+    Inputs
+    -------------------------
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    job (str) : name of the job, see queueAutograde().
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+
+    -------------------------
+    Outputs
+    -------------------------
+    dict with job, total, pending, running, graded, failed (finished without a score, including notebooks stopped by
+    a limit), done (graded + failed), elapsed (seconds since the last run started), rate (notebooks per second in
+    that run), eta_seconds (None until the rate is known) and failures (list of {assignment, student_id, status,
+    message}).
+    """
+    coursepath = os.path.join(opath, coursename)
+    con = _queue_connect(coursepath)
+    try:
+        counts = dict(con.execute('SELECT status, COUNT(*) FROM tasks WHERE job = ? GROUP BY status', (job,)))
+        run = con.execute('SELECT run_started, run_finished FROM jobs WHERE job = ?', (job,)).fetchone()
+        finished = con.execute('SELECT COUNT(*) FROM tasks WHERE job = ? AND finished_at >= ?',
+                               (job, run[0] if run else float('inf'))).fetchone()[0]
+        failures = con.execute("""SELECT assignment, student_id, status, message FROM tasks
+                                  WHERE job = ? AND status NOT IN ('pending', 'running', 'graded')
+                                  ORDER BY finished_at""", (job,)).fetchall()
+    finally:
+        con.close()
+
+    total = sum(counts.values())
+    pending, running, graded = counts.get('pending', 0), counts.get('running', 0), counts.get('graded', 0)
+    elapsed = ((run[1] or time.time()) - run[0]) if run else 0.0
+    rate = finished / elapsed if elapsed > 0 else 0.0
+    remaining = pending + running
+    return {'job': job, 'total': total, 'pending': pending, 'running': running, 'graded': graded,
+            'failed': total - remaining - graded, 'done': total - remaining, 'elapsed': elapsed, 'rate': rate,
+            'eta_seconds': 0.0 if not remaining else (remaining / rate if rate else None),
+            'failures': [dict(zip(['assignment', 'student_id', 'status', 'message'], f)) for f in failures]}
+
+def _print_progress(progress):
+    """
+    runQueue() callback that prints one progress line per finished notebook.
+    """
+    eta = progress['eta_seconds']
+    print(f"[{progress['job']}] {progress['done']}/{progress['total']} notebooks done, {progress['failed']} failed, "
+          f"{progress['running']} running, ETA {'unknown' if eta is None else f'{eta / 60:.1f} min'}")
+
+async def runQueue(coursename, job, opath=os.getcwd(), workers=None, timeout=None, cpu_limit=None, memory_limit=None,
+                   callback=None):
+    """
+    Asyncio job runner for the tasks put on the queue by queueAutograde(). Up to `workers` notebooks are graded at
+    once, each worker in its own course copy under scratch/queue_job/ (like parallelAutograde()). Every graded
+    notebook is merged into gradebook.db and marked done on the queue as soon as it finishes. Tasks left running by
+    a crash or a kernel restart go back on the queue, so running the job again resumes where it stopped.
+
+    In a notebook, start it in the background with `task = asyncio.ensure_future(runQueue(coursename, job))`, poll
+    gradingProgress() while it runs and stop it with task.cancel(); the running notebooks are then killed and put
+    back on the queue. Outside of an event loop use asyncio.run(runQueue(coursename, job)). Only one runner per job.
+
+    -------------------------
+    Inputs
+    -------------------------
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    job (str) : name of the job, see queueAutograde().
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    workers (int) : number of notebooks graded at once. Default is the number of CPUs.
+    timeout, cpu_limit, memory_limit : limits of each notebook, see parallelAutograde().
+    callback (callable) : called with gradingProgress() when the run starts and after every finished notebook, e.g.
+                          _print_progress. May be a coroutine function.
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per task graded in this run, see parallelAutograde(), also saved as
+    scratch/job_times.csv. Tasks finished by earlier runs of the job are in gradingProgress().
+    """
+    coursepath = os.path.join(opath, coursename)
+    workroot = os.path.join(coursepath, 'scratch', f'queue_{job}')
+    loop = asyncio.get_running_loop()
+    con = _queue_connect(coursepath)
+    with con:
+        con.execute("UPDATE tasks SET status = 'pending' WHERE job = ? AND status = 'running'", (job,))
+    anames = [a for a, in con.execute("SELECT DISTINCT assignment FROM tasks WHERE job = ? AND status = 'pending'",
+                                      (job,))]
+    pending = con.execute("SELECT COUNT(*) FROM tasks WHERE job = ? AND status = 'pending'", (job,)).fetchone()[0]
+    workers = max(1, min(workers or os.cpu_count() or 1, pending or 1))
+    run_started = time.time()
+    with con:
+        con.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, NULL)', (job, workers, run_started))
+
+    limits = {'timeout': timeout, 'cpu_limit': cpu_limit, 'memory_limit': memory_limit}
+    stop = threading.Event()
+    merge_lock = asyncio.Lock()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def report():
+        if callback is not None:
+            result = callback(gradingProgress(coursename, job, opath))
+            if asyncio.iscoroutine(result):
+                await result
+
+    def claim(worker):
+        # Runs on the event loop between awaits, so no two workers can claim the same task
+        task = con.execute("""SELECT assignment, student_id FROM tasks WHERE job = ? AND status = 'pending'
+                              ORDER BY assignment, student_id LIMIT 1""", (job,)).fetchone()
+        if task is not None:
+            with con:
+                con.execute("""UPDATE tasks SET status = 'running', attempts = attempts + 1, worker = ?, started_at = ?
+                               WHERE job = ? AND assignment = ? AND student_id = ?""",
+                            (worker, time.time(), job) + task)
+        return task
+
+    def prepare(workpath):
+        _copy_shard(coursepath, workpath, [])
+        for aname in anames:
+            shutil.copytree(os.path.join(coursepath, 'source', aname), os.path.join(workpath, 'source', aname))
+
+    def grade(workpath, aname, user):
+        submission = os.path.join(workpath, 'submitted', user, aname)
+        if os.path.exists(submission):
+            shutil.rmtree(submission)
+        shutil.copytree(os.path.join(coursepath, 'submitted', user, aname), submission)
+        return _autograde_one(workpath, aname, user, limits, stop)
+
+    async def work(i):
+        workpath = os.path.join(workroot, f'worker_{i}')
+        await loop.run_in_executor(executor, prepare, workpath)
+        while (task := claim(i)) is not None:
+            result = await loop.run_in_executor(executor, grade, workpath, *task)
+            if result['status'] == 'graded':
+                async with merge_lock:
+                    await loop.run_in_executor(executor, _merge_shard, coursepath, workpath, [task])
+            with con:
+                con.execute("""UPDATE tasks SET status = ?, seconds = ?, cpu_seconds = ?, peak_rss_mb = ?, message = ?,
+                               finished_at = ? WHERE job = ? AND assignment = ? AND student_id = ?""",
+                            (result['status'], result['seconds'], result['cpu_seconds'], result['peak_rss_mb'],
+                             result['message'], time.time(), job) + task)
+            await report()
+
+    start = time.perf_counter()
+    await report()
+    workers_running = [asyncio.ensure_future(work(i)) for i in range(workers)] if pending else []
+    try:
+        await asyncio.gather(*workers_running)
+    finally:
+        # Cancelled or failed: kill the running notebooks and put them back on the queue
+        stop.set()
+        for w in workers_running:
+            w.cancel()
+        await asyncio.gather(*workers_running, return_exceptions=True)
+        executor.shutdown(wait=True)
+        with con:
+            con.execute("UPDATE tasks SET status = 'pending' WHERE job = ? AND status = 'running'", (job,))
+            con.execute('UPDATE jobs SET run_finished = ? WHERE job = ?', (time.time(), job))
+        results = [dict(zip(['assignment', 'student_id', 'status', 'seconds', 'cpu_seconds', 'peak_rss_mb',
+                             'message', 'shard'], row))
+                   for row in con.execute("""SELECT assignment, student_id, status, seconds, cpu_seconds, peak_rss_mb,
+                                             message, worker FROM tasks
+                                             WHERE job = ? AND status != 'pending' AND started_at >= ?""",
+                                          (job, run_started))]
+        con.close()
+    if os.path.exists(workroot):
+        shutil.rmtree(workroot)
+    return _autograde_summary(results, workers, time.perf_counter() - start,
+                              os.path.join(coursepath, 'scratch', f'{job}_times.csv'))
+
+def _run_coroutine(coro):
+    """
+    Runs a coroutine to completion from blocking code, also from inside a notebook whose event loop is running.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+def _zip_tree(zf, path, arcname):
+    """
+    Adds the folder at path to the open zip file zf under arcname.
+    """
+    for root, _, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            zf.write(full, os.path.join(arcname, os.path.relpath(full, path)))
+
+def _pack_bundle(coursepath, bundle_path, tasks, meta):
+    """
+    Writes a self-contained work bundle for (aname, user) tasks: the course config and gradebook.db, the source of
+    every assignment, the submissions of the tasks and bundle.json (meta plus the tasks). The zip only appears under
+    its name once it is complete.
+    """
+    tmp = bundle_path + '.tmp'
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.write(os.path.join(coursepath, 'nbgrader_config.py'), 'nbgrader_config.py')
+        zf.write(os.path.join(coursepath, 'gradebook.db'), 'gradebook.db')
+        for aname in sorted(set(aname for aname, _ in tasks)):
+            _zip_tree(zf, os.path.join(coursepath, 'source', aname), os.path.join('source', aname))
+        for aname, user in tasks:
+            _zip_tree(zf, os.path.join(coursepath, 'submitted', user, aname), os.path.join('submitted', user, aname))
+        zf.writestr('bundle.json', json.dumps(dict(meta, tasks=tasks)))
+    os.replace(tmp, bundle_path)
+
+def _grade_bundle(bundle_path, result_path, worker_id):
+    """
+    Autogrades a claimed work bundle in a temporary course and writes the result zip: result.json (the bundle meta,
+    the worker and one result per task, see _autograde_one()), the worker's gradebook.db and the autograded notebooks.
+    Tasks of a bundle that cannot be graded at all are reported as failed.
+    """
+    with tempfile.TemporaryDirectory(prefix='grading_bundle_') as workpath:
+        with zipfile.ZipFile(bundle_path) as zf:
+            meta = json.loads(zf.read('bundle.json'))
+            zf.extractall(workpath)
+        results = []
+        for aname, user in meta['tasks']:
+            try:
+                results.append(_autograde_one(workpath, aname, user, meta['limits']))
+            except Exception as e:
+                results.append({'assignment': aname, 'student_id': user, 'status': 'failed', 'seconds': 0.0,
+                                'cpu_seconds': 0.0, 'peak_rss_mb': 0.0, 'message': f'{type(e).__name__}: {e}'})
+
+        tmp = result_path + '.tmp'
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.write(os.path.join(workpath, 'gradebook.db'), 'gradebook.db')
+            for r in results:
+                if r['status'] == 'graded':
+                    _zip_tree(zf, os.path.join(workpath, 'autograded', r['student_id'], r['assignment']),
+                              os.path.join('autograded', r['student_id'], r['assignment']))
+            zf.writestr('result.json', json.dumps(dict(meta, worker=worker_id, results=results)))
+        os.replace(tmp, result_path)
+    return results
+
+def gradingWorker(spool, worker_id=None, poll=2.0, idle_exit=None, stop_file=None):
+    """
+    Grading worker for distributedAutograde(). Claims work bundles from spool/pending/ one at a time, autogrades them
+    with its own nbgrader in a temporary course and returns the results to spool/done/. Bundles are claimed by
+    moving them to spool/running/, so any number of workers (processes on this machine or other hosts that share
+    spool, e.g. over NFS) can serve the same spool. Only nbgrader and this file are needed, the course is not.
+
+    -------------------------
+    Inputs
+    -------------------------
+    spool (str) : shared spool folder of the coordinator.
+    worker_id (str) : name of the worker in the results. Default is hostname-pid.
+    poll (float) : seconds to wait before looking for new bundles, and between touches of the bundle being graded.
+    idle_exit (float) : stop once no bundle was waiting for this many seconds. Default keeps running.
+    stop_file (str) : stop once this file exists. Default keeps running.
+
+    -------------------------
+    Outputs
+    -------------------------
+    Number of bundles graded.
+    """
+    import socket
+
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    for folder in ['pending', 'running', 'done']:
+        os.makedirs(os.path.join(spool, folder), exist_ok=True)
+
+    graded = 0
+    idle_since = time.monotonic()
+    while not (stop_file is not None and os.path.exists(stop_file)):
+        claimed = None
+        for name in sorted(n for n in os.listdir(os.path.join(spool, 'pending')) if n.endswith('.zip')):
+            try:
+                # Atomic, only one worker can move a bundle out of pending/
+                os.rename(os.path.join(spool, 'pending', name), os.path.join(spool, 'running', name))
+            except FileNotFoundError:
+                continue
+            claimed = name
+            break
+
+        if claimed is None:
+            if idle_exit is not None and time.monotonic() - idle_since > idle_exit:
+                break
+            time.sleep(poll)
+            continue
+
+        print(f'Worker {worker_id} grading bundle {claimed}')
+        running = os.path.join(spool, 'running', claimed)
+        # rename keeps the mtime of the bundle, which may be older than the lease
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(running)
+        done = threading.Event()
+
+        def heartbeat():
+            # Tells the coordinator the bundle is still being worked on, see lease in distributedAutograde()
+            while not done.wait(poll):
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(running)
+
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            results = _grade_bundle(running, os.path.join(spool, 'done', claimed), worker_id)
+        finally:
+            done.set()
+            beat.join()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(running)
+        print(f"Worker {worker_id} returned bundle {claimed}: "
+              f"{sum(r['status'] == 'graded' for r in results)}/{len(results)} notebooks graded")
+        graded += 1
+        idle_since = time.monotonic()
+    return graded
+
+def distributedAutograde(aname, coursename, users=None, opath=os.getcwd(), spool=None, local_workers=1,
+                         bundle_size=None, timeout=None, cpu_limit=None, memory_limit=None, lease=None, wait=None,
+                         poll=1.0):
+    """
+    Coordinator of distributed autograding. The submissions are packed into self-contained work bundles (see
+    _pack_bundle()) of bundle_size students in the spool folder, workers (see gradingWorker()) grade them with their
+    own nbgrader and return the autograded notebooks and their gradebook.db, and the coordinator merges every
+    returned bundle into autograded/ and the central gradebook.db as soon as it arrives. Workers never touch the
+    course, so they can run on other machines that share the spool folder:
+        python gradingFunctions.py worker /shared/spool
+    On one machine, local_workers worker processes are started for the run.
+
+    -------------------------
+    Inputs
+    -------------------------
+    aname (str) : assignment name (not including extension).
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    users (list) : students to autograde. Default is every student with a submitted/user/aname folder.
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    spool (str) : folder shared with the workers. Default is scratch/aname/spool, for local workers only.
+    local_workers (int) : worker processes started on this machine, 0 to only use workers started elsewhere.
+    bundle_size (int) : students per bundle. Smaller bundles spread better over workers of different speeds. Default
+                        is about four bundles per local worker and at most 25 students per bundle.
+    timeout, cpu_limit, memory_limit : limits of each notebook, see parallelAutograde(). They travel in the bundles,
+                                       so every worker applies the same limits.
+    lease (float) : seconds after which a bundle whose worker stopped reporting (workers touch their bundle every
+                    poll seconds, see gradingWorker()) goes back to pending/ for another worker. Default never.
+    wait (float) : seconds to wait for all bundles. Bundles not returned by then are withdrawn and their students
+                   reported as failed, to be retried on the next run. Default waits until all are returned.
+    poll (float) : seconds between looks at spool/done/.
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per student, see parallelAutograde(); shard is the worker that graded the
+    notebook. It is also saved as scratch/aname/autograde_times.csv.
+    """
+    coursepath = os.path.abspath(os.path.join(opath, coursename))
+    subpath = os.path.join(coursepath, 'submitted')
+    assignment_scratch = os.path.join(coursepath, 'scratch', aname)
+    spool = os.path.abspath(spool or os.path.join(assignment_scratch, 'spool'))
+    for folder in ['pending', 'running', 'done']:
+        os.makedirs(os.path.join(spool, folder), exist_ok=True)
+
+    if users is None:
+        users = sorted(u for u in os.listdir(subpath) if os.path.exists(os.path.join(subpath, u, aname)))
+    tasks = [(aname, user) for user in users]
+    job = f'{os.path.basename(coursepath)}_{aname}_{time.strftime("%Y%m%d%H%M%S")}_{os.getpid()}'
+    limits = {'timeout': timeout, 'cpu_limit': cpu_limit, 'memory_limit': memory_limit}
+    bundle_size = bundle_size or max(1, min(25, -(-len(tasks) // (4 * max(1, local_workers)))))
+
+    start = time.perf_counter()
+    bundles = {}
+    for i in range(0, len(tasks), bundle_size):
+        name = f'{job}_{i // bundle_size:04d}.zip'
+        bundles[name] = tasks[i:i + bundle_size]
+        _pack_bundle(coursepath, os.path.join(spool, 'pending', name), bundles[name],
+                     {'job': job, 'bundle': name, 'limits': limits})
+    print(f'{len(tasks)} notebooks packed into {len(bundles)} bundles in {spool}')
+
+    stop_file = os.path.join(spool, f'{job}.stop')
+    pool = ProcessPoolExecutor(max_workers=local_workers) if local_workers and bundles else None
+    local = [pool.submit(gradingWorker, spool, f'local-{i}', poll, None, stop_file)
+             for i in range(local_workers)] if pool else []
+
+    results = []
+    workers = set()
+    waiting = set(bundles)
+    mergeroot = os.path.join(assignment_scratch, 'merge')
+    try:
+        while waiting:
+            for name in sorted(waiting & set(os.listdir(os.path.join(spool, 'done')))):
+                done = os.path.join(spool, 'done', name)
+                workpath = os.path.join(mergeroot, name[:-4])
+                with zipfile.ZipFile(done) as zf:
+                    zf.extractall(workpath)
+                with open(os.path.join(workpath, 'result.json')) as f:
+                    returned = json.load(f)
+                graded = [(r['assignment'], r['student_id']) for r in returned['results'] if r['status'] == 'graded']
+                _merge_shard(coursepath, workpath, graded)
+                for r in returned['results']:
+                    r['shard'] = returned['worker']
+                results.extend(returned['results'])
+                workers.add(returned['worker'])
+                shutil.rmtree(workpath)
+                os.remove(done)
+                waiting.discard(name)
+                print(f"Merged bundle {name} from {returned['worker']}: {len(graded)}/{len(returned['results'])} "
+                      f"notebooks graded, {len(bundles) - len(waiting)}/{len(bundles)} bundles done")
+
+            if lease is not None:
+                for name in waiting & set(os.listdir(os.path.join(spool, 'running'))):
+                    running = os.path.join(spool, 'running', name)
+                    with contextlib.suppress(FileNotFoundError):
+                        if time.time() - os.path.getmtime(running) > lease:
+                            os.rename(running, os.path.join(spool, 'pending', name))
+                            print(f'Bundle {name} was not heard from for {lease} s, it goes back to pending.')
+
+            if any(f.done() and f.exception() is not None for f in local):
+                raise next(f.exception() for f in local if f.done() and f.exception() is not None)
+            if wait is not None and time.perf_counter() - start > wait:
+                break
+            if waiting:
+                time.sleep(poll)
+    finally:
+        # Withdraw what was not returned, a late result of a withdrawn bundle is never merged
+        with open(stop_file, 'w'):
+            pass
+        for folder in ['pending', 'running', 'done']:
+            for name in waiting & set(os.listdir(os.path.join(spool, folder))):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(spool, folder, name))
+        if pool is not None:
+            pool.shutdown(wait=True)
+        # Results of bundles that went back to pending/ and were graded twice
+        for name in set(bundles) & set(os.listdir(os.path.join(spool, 'done'))):
+            os.remove(os.path.join(spool, 'done', name))
+        os.remove(stop_file)
+        if os.path.exists(mergeroot):
+            shutil.rmtree(mergeroot)
+
+    for name in sorted(waiting):
+        results += [{'assignment': a, 'student_id': u, 'status': 'failed', 'seconds': 0.0, 'cpu_seconds': 0.0,
+                     'peak_rss_mb': 0.0, 'message': f'bundle {name} was not returned within {wait} s', 'shard': None}
+                    for a, u in bundles[name]]
+    return _autograde_summary(results, len(workers), time.perf_counter() - start,
+                              os.path.join(assignment_scratch, 'autograde_times.csv'))
+
+# Blackboard names every file "<assignment>_<username>_attempt_<YYYY-MM-DD-HH-MM-SS>" followed by ".txt" for the
+# receipt or "_<original filename>" for each uploaded file
+_BB_MEMBER = re.compile(r'^(?P<prefix>(?P<stem>.*_(?P<username>[^_]+))_attempt_'
+                        r'(?P<attempt>\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}))(?:\.txt|_(?P<filename>.+))$')
+# The first line of a receipt names the student as "Name: First Last (username)"
+_BB_RECEIPT_USER = re.compile(r'\(([^()\s]+)\)')
+
+def indexSubmissions(zip_path, all_attempts=False):
+    """
+    Builds an index of a Blackboard submission zip in one pass over its member names, without extracting it.
+
+    Members are grouped on their Blackboard attempt prefix (assignment, username and attempt timestamp), so the order
+    of the files in the zip does not matter. For each student the newest attempt that contains a notebook is selected;
+    a student whose attempts contain no notebook is listed with notebook None (a blank submission). The username is
+    read from the receipt of the selected attempt only, since a username with underscores cannot be told apart from
+    the assignment name in the file names. Without a receipt the last part of the file name is used.
+
+    -------------------------
+    Inputs
+    -------------------------
+    zip_path (str or zipfile.ZipFile) : path to the Blackboard zip, or an already open ZipFile.
+    all_attempts (bool) : return every attempt instead of only the selected one per student. The 'selected'
+                          column marks the attempt that would be graded.
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame sorted by username with columns
+        username (str), attempt (Timestamp), attempts (int, number of attempts by the student), receipt (str, .txt
+        member name), notebook (str, .ipynb member name or None), selected (bool).
+    Members that do not follow the Blackboard naming scheme are printed and left out.
+    """
+    import pandas as pd
+
+    zf = zip_path if isinstance(zip_path, zipfile.ZipFile) else zipfile.ZipFile(zip_path, 'r')
+    try:
+        attempts = {}
+        unrecognised = []
+        for member in zf.namelist():
+            match = _BB_MEMBER.match(os.path.basename(member))
+            if match is None:
+                if not member.endswith('/'):
+                    unrecognised.append(member)
+                continue
+            entry = attempts.setdefault(match['prefix'], {'stem': match['stem'], 'username': match['username'],
+                                                          'attempt': match['attempt'], 'receipt': None,
+                                                          'notebook': None})
+            if match['filename'] is None:
+                entry['receipt'] = member
+            elif match['filename'].endswith('.ipynb'):
+                if entry['notebook'] is not None:
+                    print(f"Attempt {match['prefix']} has more than one notebook, using {entry['notebook']}")
+                    continue
+                entry['notebook'] = member
+
+        # One student per stem (assignment and username); the newest attempt with a notebook wins, timestamps are
+        # fixed width so they compare as strings
+        counts = {}
+        selected = {}
+        for prefix, entry in attempts.items():
+            stem = entry['stem']
+            counts[stem] = counts.get(stem, 0) + 1
+            best = selected.get(stem)
+            key = (entry['notebook'] is not None, entry['attempt'])
+            if best is None or key > (attempts[best]['notebook'] is not None, attempts[best]['attempt']):
+                selected[stem] = prefix
+
+        usernames = {}
+        for stem, prefix in selected.items():
+            receipt = attempts[prefix]['receipt']
+            firstline = zf.read(receipt).decode('utf-8', 'replace').split('\n', 1)[0] if receipt else ''
+            found = _BB_RECEIPT_USER.search(firstline)
+            if found:
+                usernames[stem] = found[1]
+            else:
+                usernames[stem] = attempts[prefix]['username']
+                print(f"No username in the receipt of {prefix}, using {usernames[stem]} from the file name.")
+    finally:
+        if zf is not zip_path:
+            zf.close()
+
+    if unrecognised:
+        print(f'{len(unrecognised)} files in the zip do not follow the Blackboard naming scheme: {unrecognised}')
+
+    rows = [dict(entry, username=usernames[entry['stem']], attempts=counts[entry['stem']],
+                 selected=selected[entry['stem']] == prefix)
+            for prefix, entry in attempts.items() if all_attempts or selected[entry['stem']] == prefix]
+    index = pd.DataFrame(rows, columns=['username', 'attempt', 'attempts', 'receipt', 'notebook', 'selected'])
+    index['attempt'] = pd.to_datetime(index['attempt'], format='%Y-%m-%d-%H-%M-%S')
+    chosen = index.loc[index['selected'], 'username']
+    duplicated = chosen[chosen.duplicated()]
+    if len(duplicated):
+        print(f'Receipts of different file names name the same students, check the zip: {sorted(set(duplicated))}')
+    return index.sort_values(['username', 'attempt']).reset_index(drop=True)
+
+def _score_column(gradebook, aname, score_col=None):
+    """
+    Name of the Blackboard gradebook column that receives the scores of assignment aname. An explicit score_col
+    wins; otherwise the only "[Total Pts: ...]" column, then a column whose name contains aname, and finally the
+    last column (the old behaviour) is used.
+    """
+    if score_col is not None:
+        assert score_col in gradebook.columns, f'Column {score_col} is not in the gradebook'
+        return score_col
+
+    graded_cols = [c for c in gradebook.columns if '[Total Pts' in str(c)]
+    if len(graded_cols) == 1:
+        return graded_cols[0]
+    key = re.sub(r'[^a-z0-9]', '', aname.lower())
+    named_cols = [c for c in graded_cols if key in re.sub(r'[^a-z0-9]', '', str(c).lower())]
+    if len(named_cols) == 1:
+        return named_cols[0]
+    print(f'Could not identify the gradebook column for {aname}, using the last column: {gradebook.columns[-1]}')
+    return gradebook.columns[-1]
+
+def _merge_scores(gradebook, scores, score_col):
+    """
+    Writes scores (a Series indexed by username) into gradebook[score_col] with a join on the Username column.
+    Students without a score keep their current entry. Returns the usernames that are not in the gradebook.
+    Usernames are compared as strings, so numeric usernames match whichever way they were read.
+    """
+    scores = scores.set_axis(scores.index.astype(str))
+    scores = scores[~scores.index.duplicated(keep='last')]
+    gradebook['Username'] = gradebook['Username'].astype(str)
+    matched = gradebook['Username'].isin(scores.index)
+    gradebook[score_col] = gradebook[score_col].astype(object)
+    gradebook.loc[matched, score_col] = gradebook.loc[matched, 'Username'].map(scores)
+
+    unmatched = scores.index.difference(gradebook['Username']).tolist()
+    if unmatched:
+        print(f'{len(unmatched)} graded students are not in the Blackboard gradebook: {", ".join(map(str, unmatched))}')
+    return unmatched
+
+def _ingest_zip(aname, coursepath, zpath, incremental=True):
+    """
+    Streams the newest notebook of every student from a Blackboard zip into submitted/user/aname/aname.ipynb.
+
+    With incremental, submissions whose hash matches scratch/aname/manifest.json (and that still have an autograded
+    notebook) are skipped; a changed source notebook starts a fresh manifest. Returns (usernames with a notebook,
+    usernames copied for autograding, {username: submission hash}, manifest).
+    """
+    subpath = os.path.join(coursepath,'submitted')
+    assignment_scratch = os.path.join(coursepath,'scratch',aname)
+    os.makedirs(assignment_scratch, exist_ok=True)
+
+    manifest = _load_manifest(assignment_scratch)
+    source_hash = _file_hash(os.path.join(coursepath,'source',aname,f'{aname}.ipynb'))
+    if not incremental or manifest['source'] != source_hash:
+        if manifest['source'] is not None:
+            print('Source notebook changed (or full regrade requested), regrading every submission.')
+        manifest = {'source': source_hash, 'submissions': {}}
+
+    copied = []
+    unchanged = []
+    hashes = {}
+
+    # Read the member index once and stream each notebook straight into submitted/
+    with zipfile.ZipFile(zpath, 'r') as zf:
+        index = indexSubmissions(zf)
+        for user in index.loc[index['notebook'].isna(), 'username']:
+            print(f'Student {user} submitted a blank submission')
+        for user, n in zip(index['username'], index['attempts']):
+            if n > 1:
+                print(f'Student {user} submitted {n} attempts, grading the newest one')
+        index = index.dropna(subset=['notebook'])
+        usernames = index['username'].tolist()
+        notebooks = index['notebook'].tolist()
+        print('------------------------------------------------------------------------------------------')
+
+        for user, notebook in zip(usernames,notebooks):
+            usersubpath = os.path.join(subpath,user)
+            if os.path.exists(usersubpath):
+                student_assign_sub_path = os.path.join(usersubpath,aname)
+                try:
+                    os.mkdir(student_assign_sub_path)
+                except FileExistsError:
+                    pass
+
+                # Hash while writing, the tmp file only replaces the submission if it changed
+                assignment_sub_path = os.path.join(student_assign_sub_path, f'{aname}.ipynb')
+                with zf.open(notebook) as src, open(assignment_sub_path + '.tmp', 'wb') as dst:
+                    hashes[user] = _stream_hash(src, dst)
+                autograded_user_path = os.path.join(coursepath,'autograded',user,aname)
+                if manifest['submissions'].get(user) == hashes[user] and os.path.exists(autograded_user_path):
+                    os.remove(assignment_sub_path + '.tmp')
+                    unchanged.append(user)
+                    continue
+                os.replace(assignment_sub_path + '.tmp', assignment_sub_path)
+                copied.append(user)
+
+                # Stale results would make nbgrader skip this student
+                for stale in [autograded_user_path, os.path.join(coursepath,'feedback',user,aname)]:
+                    if os.path.exists(stale):
+                        shutil.rmtree(stale)
+            else:
+                print(f'No submitted folder for student {user}.')
+    print(f'{len(copied)} new or changed submissions to autograde, {len(unchanged)} unchanged submissions skipped.')
+
+    return usernames, copied, hashes, manifest
+
+def _record_manifest(aname, coursepath, manifest, copied, hashes):
+    """
+    Only record submissions that actually produced an autograded notebook, failures are retried next run.
+    """
+    for user in copied:
+        if os.path.exists(os.path.join(coursepath,'autograded',user,aname,f'{aname}.ipynb')):
+            manifest['submissions'][user] = hashes[user]
+    _save_manifest(os.path.join(coursepath,'scratch',aname), manifest)
+
+def _notebook_cells(notebook_path):
+    """
+    (cell_type, source, student written) of every cell of a notebook. Student written cells are nbgrader solution
+    cells and code cells without nbgrader metadata (added by the student, or every cell of a plain notebook).
+    Outputs are skipped while streaming with ijson, so large images are never loaded.
+    """
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+    if ijson is None:
+        with open(notebook_path, 'r', encoding='utf-8') as f:
+            cells = json.load(f).get('cells', [])
+        return [(c.get('cell_type'), ''.join(c['source']) if isinstance(c.get('source'), list) else c.get('source', ''),
+                 c.get('metadata', {}).get('nbgrader', {}).get('solution', 'nbgrader' not in c.get('metadata', {})))
+                for c in cells]
+
+    cells = []
+    with open(notebook_path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f):
+            if prefix == 'cells.item' and event == 'start_map':
+                cell = {'cell_type': None, 'source': '', 'nbgrader': False, 'solution': False}
+            elif prefix == 'cells.item' and event == 'end_map':
+                cells.append((cell['cell_type'], cell['source'], cell['solution'] or not cell['nbgrader']))
+            elif prefix == 'cells.item.cell_type':
+                cell['cell_type'] = value
+            elif prefix in ('cells.item.source', 'cells.item.source.item') and event == 'string':
+                cell['source'] += value
+            elif prefix == 'cells.item.metadata.nbgrader' and event == 'start_map':
+                cell['nbgrader'] = True
+            elif prefix == 'cells.item.metadata.nbgrader.solution':
+                cell['solution'] = value
+    return cells
+
+def _code_tokens(source):
+    """
+    Normalised tokens of student code for similarity: comments, blank lines and IPython magics are dropped, names
+    become 'v' (except keywords, builtins and attributes) and strings become 'S', so renaming variables or rewording
+    comments does not hide a copy.
+    """
+    import builtins
+    import io
+    import keyword
+    import tokenize
+
+    source = '\n'.join(l for l in source.splitlines() if not l.lstrip().startswith(('%', '!')))
+    tokens = []
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+            if tok.type in (tokenize.COMMENT, tokenize.NL, tokenize.ENDMARKER):
+                continue
+            if tok.type == tokenize.NAME and not keyword.iskeyword(tok.string) and not hasattr(builtins, tok.string) \
+                    and not (tokens and tokens[-1] == '.'):
+                tokens.append('v')
+            elif tok.type == tokenize.STRING:
+                tokens.append('S')
+            elif tok.type in (tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT):
+                tokens.append(tokenize.tok_name[tok.type])
+            else:
+                tokens.append(tok.string)
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        tokens = source.split()
+    return tokens
+
+def _minhash(tokens, a, b, shingle=5):
+    """
+    MinHash signature (one value per row of a and b) of the set of `shingle`-token windows of tokens.
+    """
+    import numpy as np
+
+    windows = {' '.join(tokens[i:i + shingle]) for i in range(max(1, len(tokens) - shingle + 1))}
+    x = np.array([int.from_bytes(hashlib.blake2b(w.encode(), digest_size=4).digest(), 'little') for w in windows],
+                 dtype=np.uint64)
+    # a < 2**31 and x < 2**32 so a * x + b fits in 64 bits
+    return ((a[:, None] * x[None, :] + b[:, None]) % np.uint64(2 ** 31 - 1)).min(axis=1)
+
+def similarityIndex(aname, coursename, users=None, opath=os.getcwd(), threshold=0.8, num_perm=64, bands=16):
+    """
+    Fingerprints every submitted notebook of an assignment to find copies without comparing all pairs.
+
+    Each notebook gets two hashes: notebook_key over the source of all its cells (identical notebooks, which
+    autogradeAssignment() only executes once) and code_key over the normalised tokens of the student written code
+    (see _code_tokens(), the same code with other names, comments or markdown). Notebooks with the same code_key form a
+    group. One MinHash signature per group is split into `bands` bands for locality-sensitive hashing, and only groups
+    that share a band are compared, so the cost grows with the number of submissions, not its square.
+
+    -------------------------
+    Inputs
+    -------------------------
+    aname (str) : assignment name (not including extension).
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    users (list) : students to index. Default is every student with a submitted/user/aname notebook.
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    threshold (float) : estimated Jaccard similarity of the code shingles from which two groups are reported.
+    num_perm (int) : length of the MinHash signatures, must be a multiple of bands.
+    bands (int) : LSH bands. Groups more similar than about (1 / bands) ** (bands / num_perm) become candidates.
+
+    -------------------------
+    Outputs
+    -------------------------
+    (groups, pairs) pandas DataFrames, also saved as scratch/aname/similarity_groups.csv and similarity_pairs.csv.
+    groups has one row per student: student_id, notebook_key, code_key, group and group_size. pairs has one row per
+    pair of similar groups: group_a, group_b, student_a, student_b (the first student of each group), size_a, size_b
+    and similarity, most similar first.
+    """
+    import numpy as np
+    import pandas as pd
+
+    coursepath = os.path.join(opath, coursename)
+    subpath = os.path.join(coursepath, 'submitted')
+    assignment_scratch = os.path.join(coursepath, 'scratch', aname)
+    os.makedirs(assignment_scratch, exist_ok=True)
+    if users is None:
+        users = sorted(os.listdir(subpath))
+    users = [u for u in users if os.path.exists(os.path.join(subpath, u, aname, f'{aname}.ipynb'))]
+
+    rows = []
+    tokens = {}
+    for user in users:
+        cells = _notebook_cells(os.path.join(subpath, user, aname, f'{aname}.ipynb'))
+        code = [t for cell_type, source, student in cells if cell_type == 'code' and student
+                for t in _code_tokens(source) + ['\n']]
+        code_key = hashlib.sha256(' '.join(code).encode()).hexdigest()[:16]
+        notebook_key = hashlib.sha256(json.dumps([c[:2] for c in cells]).encode()).hexdigest()[:16]
+        rows.append({'student_id': user, 'notebook_key': notebook_key, 'code_key': code_key})
+        tokens.setdefault(code_key, code)
+
+    groups = pd.DataFrame(rows, columns=['student_id', 'notebook_key', 'code_key'])
+    groups['group'] = groups.groupby('code_key', sort=False).ngroup()
+    groups['group_size'] = groups.groupby('group')['student_id'].transform('size')
+    first = groups.drop_duplicates('group').set_index('group')
+
+    rng = np.random.default_rng(0)
+    a = rng.integers(1, 2 ** 31 - 1, num_perm, dtype=np.uint64)
+    b = rng.integers(0, 2 ** 31 - 1, num_perm, dtype=np.uint64)
+    signatures = np.array([_minhash(tokens[key], a, b) for key in first['code_key']]).reshape(len(first), num_perm)
+
+    rows_per_band = num_perm // bands
+    candidates = set()
+    for band in range(bands):
+        buckets = {}
+        for g, sig in enumerate(signatures[:, band * rows_per_band:(band + 1) * rows_per_band]):
+            buckets.setdefault(sig.tobytes(), []).append(g)
+        for members in buckets.values():
+            candidates.update((i, j) for k, i in enumerate(members) for j in members[k + 1:])
+
+    pairs = []
+    for i, j in sorted(candidates):
+        similarity = float(np.mean(signatures[i] == signatures[j]))
+        if similarity >= threshold:
+            pairs.append({'group_a': i, 'group_b': j, 'student_a': first.at[i, 'student_id'],
+                          'student_b': first.at[j, 'student_id'], 'size_a': first.at[i, 'group_size'],
+                          'size_b': first.at[j, 'group_size'], 'similarity': similarity})
+    pairs = pd.DataFrame(pairs, columns=['group_a', 'group_b', 'student_a', 'student_b', 'size_a', 'size_b',
+                                         'similarity']).sort_values('similarity', ascending=False)
+
+    groups.to_csv(os.path.join(assignment_scratch, 'similarity_groups.csv'), index=False)
+    pairs.to_csv(os.path.join(assignment_scratch, 'similarity_pairs.csv'), index=False)
+    copies = groups[groups['group_size'] > 1]
+    print(f"Similarity index: {len(groups)} notebooks, {len(groups) - groups['notebook_key'].nunique()} identical "
+          f"copies, {copies['group'].nunique()} groups with the same code ({len(copies)} students), "
+          f"{len(pairs)} pairs of groups at least {threshold:.0%} similar.")
+    return groups, pairs
+
+def _dedup_submissions(aname, coursename, opath, usernames, copied):
+    """
+    Indexes the class with similarityIndex() and splits the students to autograde into the ones whose notebook has to
+    run and {student: graded student} duplicates of an identical notebook. Students already graded from an identical
+    notebook are used before running a new one.
+    """
+    coursepath = os.path.join(opath, coursename)
+    groups, _ = similarityIndex(aname, coursename, users=usernames, opath=opath)
+    keys = dict(zip(groups['student_id'], groups['notebook_key']))
+    pending = set(copied)
+    graded = {}
+    for user, key in keys.items():
+        if user not in pending and os.path.exists(os.path.join(coursepath, 'autograded', user, aname, f'{aname}.ipynb')):
+            graded.setdefault(key, user)
+
+    to_grade, duplicates = [], {}
+    for user in copied:
+        key = keys.get(user)
+        if key is None:
+            to_grade.append(user)
+        elif key in graded:
+            duplicates[user] = graded[key]
+        else:
+            graded[key] = user
+            to_grade.append(user)
+    if duplicates:
+        print(f'{len(duplicates)} identical notebooks are not executed, they get the results of the same notebook.')
+    return to_grade, duplicates
+
+def _fan_out(coursepath, aname, duplicates):
+    """
+    Gives each {student: graded student} duplicate the autograded notebook and the gradebook.db scores of the student
+    whose identical notebook was executed. Duplicates of a notebook that failed are left ungraded.
+    """
+    records = {}
+    for user, source in duplicates.items():
+        src = os.path.join(coursepath, 'autograded', source, aname)
+        if not os.path.exists(os.path.join(src, f'{aname}.ipynb')):
+            continue
+        dst = os.path.join(coursepath, 'autograded', user, aname)
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst)
+        if source not in records:
+            records[source] = _read_submission_grades(coursepath, aname, source)
+        _write_submission_grades(coursepath, aname, user, records[source])
+
+def _feedback_tasks(coursepath, aname, users=None, force=False):
+    """
+    Students of aname whose feedback is missing or older than their autograded notebook. The hash of the autograded
+    notebook each feedback file was made from is kept in scratch/aname/feedback.json. Returns (users to generate,
+    {user: autograded notebook hash}, feedback manifest).
+    """
+    autogradedpath = os.path.join(coursepath, 'autograded')
+    if users is None:
+        users = sorted(os.listdir(autogradedpath))
+    users = [u for u in users if os.path.exists(os.path.join(autogradedpath, u, aname, f'{aname}.ipynb'))]
+    manifest_path = os.path.join(coursepath, 'scratch', aname, 'feedback.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    hashes = {user: _file_hash(os.path.join(autogradedpath, user, aname, f'{aname}.ipynb')) for user in users}
+    todo = [user for user in users
+            if force or manifest.get(user) != hashes[user]
+            or not os.path.exists(os.path.join(coursepath, 'feedback', user, aname, f'{aname}.html'))]
+    return todo, hashes, manifest
+
+def _feedback_shard(coursepath, tasks):
+    """
+    Generates the feedback of (aname, user) tasks in-process, so nbgrader is only imported once per worker.
+    """
+    from nbgrader.converters import GenerateFeedback
+    from nbgrader.coursedir import CourseDirectory
+    from nbgrader.utils import capture_log
+    from traitlets.config.loader import PyFileConfigLoader
+
+    coursepath = os.path.abspath(coursepath)
+    config = PyFileConfigLoader('nbgrader_config.py', path=coursepath).load_config()
+    config.CourseDirectory.root = coursepath
+    config.CourseDirectory.db_url = 'sqlite:///' + os.path.join(coursepath, 'gradebook.db')
+
+    results = []
+    for aname, user in tasks:
+        start = time.perf_counter()
+        app = GenerateFeedback(coursedir=CourseDirectory(config=config, assignment_id=aname, student_id=user),
+                               config=config)
+        app.force = True
+        result = capture_log(app)
+        errors = [l for l in result.get('error', '').splitlines() if l.strip()]
+        html = os.path.join(coursepath, 'feedback', user, aname, f'{aname}.html')
+        ok = result['success'] and os.path.exists(html)
+        results.append({'assignment': aname, 'student_id': user, 'status': 'generated' if ok else 'failed',
+                        'seconds': time.perf_counter() - start, 'message': errors[-1] if errors else ''})
+    return results
+
+def _feedback_pool(coursepath, tasks, workers=None):
+    """
+    Runs (aname, user) feedback tasks over a process pool, split round-robin into one shard per worker. Every
+    student writes to its own feedback/ folder and gradebook.db is only read, so the workers share the course.
+    A single worker runs in this process.
+    """
+    if not tasks:
+        return []
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks)))
+    if workers == 1:
+        return _feedback_shard(coursepath, tasks)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_feedback_shard, coursepath, tasks[i::workers]) for i in range(workers)]
+        for future in as_completed(futures):
+            results.extend(future.result())
+    return results
+
+_INLINE_IMAGE = re.compile(r'data:image/(?:png|jpeg|gif);base64,[A-Za-z0-9+/=\n]+')
+
+def _cap_feedback_html(html_path, max_mb):
+    """
+    Shrinks a feedback HTML file to at most max_mb by re-encoding its inlined images (largest first) as smaller
+    JPEGs and, if that is not enough, replacing the largest plots with a note. Returns the new size in MB.
+    """
+    import base64
+    import io
+    from PIL import Image
+
+    with open(html_path, 'r', encoding='utf-8') as f:
+        html = f.read()
+    max_bytes = max_mb * 1024 * 1024
+    if len(html.encode('utf-8')) <= max_bytes:
+        return len(html.encode('utf-8')) / 1024 ** 2
+
+    images = sorted(set(_INLINE_IMAGE.findall(html)), key=len, reverse=True)
+    for uri in images:
+        if len(html.encode('utf-8')) <= max_bytes:
+            break
+        try:
+            image = Image.open(io.BytesIO(base64.b64decode(uri.split(',', 1)[1])))
+            image = image.convert('RGB')
+        except Exception:
+            continue
+        image.thumbnail((800, 800))
+        buf = io.BytesIO()
+        image.save(buf, 'JPEG', quality=60, optimize=True)
+        smaller = 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
+        if len(smaller) < len(uri):
+            html = html.replace(uri, smaller)
+
+    for uri in sorted(set(_INLINE_IMAGE.findall(html)), key=len, reverse=True):
+        if len(html.encode('utf-8')) <= max_bytes:
+            break
+        note = f'<p><em>[Plot removed to keep this feedback under {max_mb:g} MB]</em></p>'
+        while uri in html:
+            i = html.index(uri)
+            tag_start, tag_end = html.rfind('<img', 0, i), html.find('>', i)
+            html = html[:tag_start] + note + html[tag_end + 1:] if tag_start != -1 else html.replace(uri, '', 1)
+
+    with open(html_path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    return len(html.encode('utf-8')) / 1024 ** 2
+
+def _package_feedback(coursepath, aname, generated, max_mb=None, archive=False, bundle=True):
+    """
+    Caps (max_mb) and zips (archive) the freshly generated feedback and rebuilds the LMS bundle of the whole class.
+    Returns {user: html size in MB} for the generated students.
+    """
+    assignment_scratch = os.path.join(coursepath, 'scratch', aname)
+    feedbackpath = os.path.join(coursepath, 'feedback')
+    sizes = {}
+    for user in generated:
+        html = os.path.join(feedbackpath, user, aname, f'{aname}.html')
+        sizes[user] = _cap_feedback_html(html, max_mb) if max_mb else os.path.getsize(html) / 1024 ** 2
+        if archive:
+            archives = os.path.join(assignment_scratch, 'feedback_archives')
+            os.makedirs(archives, exist_ok=True)
+            with zipfile.ZipFile(os.path.join(archives, f'{user}_{aname}_feedback.zip'), 'w',
+                                 zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+                for root, _, files in os.walk(os.path.join(feedbackpath, user, aname)):
+                    for name in files:
+                        path = os.path.join(root, name)
+                        zf.write(path, os.path.relpath(path, os.path.join(feedbackpath, user)))
+
+    if bundle:
+        bundle_path = os.path.join(assignment_scratch, f'feedback_{aname}.zip')
+        with zipfile.ZipFile(bundle_path + '.part', 'w', zipfile.ZIP_DEFLATED) as zf:
+            for user in sorted(os.listdir(feedbackpath)):
+                html = os.path.join(feedbackpath, user, aname, f'{aname}.html')
+                if os.path.exists(html):
+                    zf.write(html, f'{user}_{aname}_feedback.html')
+        os.replace(bundle_path + '.part', bundle_path)
+        print(f'Feedback bundle for the LMS written to {bundle_path}')
+    return sizes
+
+def _feedback_summary(coursepath, aname, results, hashes, manifest, sizes, skipped):
+    """
+    Records the notebooks feedback was made from, prints failures and returns the per-student table.
+    """
+    import pandas as pd
+
+    for r in results:
+        if r['status'] == 'generated':
+            manifest[r['student_id']] = hashes[r['student_id']]
+        else:
+            print(f"Feedback for {r['student_id']} ({aname}) failed: {r['message']}")
+        r['html_mb'] = sizes.get(r['student_id'])
+    with open(os.path.join(coursepath, 'scratch', aname, 'feedback.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print(f'Generated feedback for {len(sizes)} students of {aname}, {skipped} unchanged.')
+    return pd.DataFrame(results, columns=['assignment', 'student_id', 'status', 'seconds', 'html_mb', 'message'])
+
+def generateFeedback(aname, coursename, users=None, workers=None, opath=os.getcwd(), force=False, max_mb=None,
+                     archive=False, bundle=True):
+    """
+    Generates the feedback HTML of an autograded assignment across a pool of worker processes, instead of a single
+    `nbgrader generate_feedback` call. Only students whose autograded notebook changed since their feedback was made
+    get new feedback (see scratch/aname/feedback.json), so it can run again at any time after autograding.
+
+    -------------------------
+    Inputs
+    -------------------------
+    aname (str) : assignment name (not including extension).
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    users (list) : student usernames to consider. Default is every student with an autograded notebook.
+    workers (int) : number of worker processes. Default is the number of CPUs, 1 runs in this process.
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    force (bool) : regenerate the feedback of every student in users, e.g. after manual grading in formgrader.
+    max_mb (float) : size cap of each feedback HTML. Larger files have their inlined plots re-encoded as smaller
+                     JPEGs and, if still too large, the largest plots replaced with a note. Default is no cap.
+    archive (bool) : also write a compressed zip per student to scratch/aname/feedback_archives/ for bulk upload.
+    bundle (bool) : write scratch/aname/feedback_aname.zip with the feedback of every student, named
+                    username_aname_feedback.html, for the LMS.
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per generated student: assignment, student_id, status ('generated' or 'failed'),
+    seconds, html_mb (size of the feedback HTML after max_mb) and message.
+    """
+    coursepath = os.path.join(opath, coursename)
+    os.makedirs(os.path.join(coursepath, 'scratch', aname), exist_ok=True)
+
+    todo, hashes, manifest = _feedback_tasks(coursepath, aname, users, force)
+    results = _feedback_pool(coursepath, [(aname, user) for user in todo], workers)
+    generated = [r['student_id'] for r in results if r['status'] == 'generated']
+    sizes = _package_feedback(coursepath, aname, generated, max_mb, archive, bundle)
+    return _feedback_summary(coursepath, aname, results, hashes, manifest, sizes, len(hashes) - len(todo))
+
+def autogradeAssignment(aname, coursename, opath=os.getcwd(), workers=1, timeout=None, incremental=True, archive_zip=True,
+                        score_col=None, zip_path=None, gradebook_path=None, cpu_limit=None, memory_limit=None,
+                        warm_kernels=0, isolation='restart', analytics='background', feedback=True, queue=False,
+                        dedup=True, distributed=False, spool=None):
     """
     Function that will autograde an assignment using nbgrader. This function assumes the file structure created by setupCourse().
 
@@ -163,225 +2260,840 @@ def autogradeAssignment(aname, coursename, opath=os.getcwd()):
                             gradebook.db
                             gradingFunctions.py
                   leaving the functions in this file in the opath directory will allow for less path management. 
+    workers (int) : number of worker processes used to autograde. Default 1 runs a single `nbgrader autograde` over the
+                    whole class; more than 1 (or None for one per CPU) uses parallelAutograde().
+    timeout (float) : wall-clock limit in seconds for each student's notebook, see parallelAutograde(). Setting it also
+                      uses parallelAutograde() even with a single worker.
+    cpu_limit, memory_limit : CPU seconds and memory (MB) each student's kernel may use, see parallelAutograde(). Like
+                              timeout, setting either uses parallelAutograde(). Notebooks that hit a limit are
+                              reported in the summary, get no score and are retried on the next run.
+    warm_kernels, isolation : keep kernels started with common imports loaded instead of starting one per notebook,
+                              see parallelAutograde(). Setting warm_kernels also uses parallelAutograde().
+    queue (bool) : autograde through the persistent job queue (job aname, see queueAutograde() and runQueue()) with
+                   a progress line per notebook. If the run is interrupted, running it again only grades the
+                   students that are not done yet. Cannot be combined with warm_kernels.
+    distributed (bool) : autograde through work bundles with distributedAutograde(), starting `workers` local worker
+                         processes (0 to only use workers started on other machines with
+                         `python gradingFunctions.py worker SPOOL`). Cannot be combined with warm_kernels.
+    spool (str) : folder shared with the workers when distributed, default scratch/aname/spool.
+    analytics (str) : when to make the plots and question statistics, see gradeAnalytics(). 'background' (default) runs
+                      them in a background process once the gradebook is written and returns its Future, 'inline'
+                      runs them before returning and displays the figures, 'off' skips them (run gradeAnalytics()
+                      later).
+    feedback (bool) : generate the feedback of the students whose autograded notebook changed with generateFeedback(),
+                      using the same number of workers, and bundle it for the LMS. Set to False to run
+                      generateFeedback() later (e.g. with a size cap or per-student archives).
+    incremental (bool) : only autograde submissions that are new or changed since the last run. The hashes of the source
+                         notebook and of each submission are kept in scratch/aname/manifest.json; a changed source
+                         notebook regrades everyone. Set to False to force a full regrade.
+    dedup (bool) : index the submissions with similarityIndex() after the ingest and execute identical notebooks only
+                   once; every student who submitted the same notebook gets a copy of its autograded notebook and
+                   scores. Always uses the per-student path of parallelAutograde() when there are identical notebooks.
+    archive_zip (bool) : move the Blackboard zip into scratch/aname once grading is done. If False the zip is deleted.
+    score_col (str) : name of the Blackboard gradebook column for this assignment. Default picks the only
+                      "[Total Pts: ...]" column, or the one whose name contains aname.
+    zip_path, gradebook_path (str) : paths to the Blackboard zip and gradebook .csv. When both are given there is no
+                                     prompt, the temp folder is not searched and both files are left where they are.
     
     -------------------------
     Ouputs
     -------------------------
     temp/ : uploadable gradebook to Blackboard
-    scratch/aname : png of grade distribution, orginal gradebook, nbgrader gradebook, final gradebook that is also in the /temp folder, 
-                    and directory /orginal_files_from_bb which houses the unzipped orginal .txt and .ipynb files. 
+    scratch/aname : png of grade distribution, orginal gradebook, scores.csv (points per question and total of every
+                    student, see scoreNotebooks()), final gradebook that is also in the /temp folder, 
+                    and the orginal Blackboard zip with the .txt and .ipynb files (see archive_zip). Notebooks are written
+                    straight from the zip into submitted/, the zip is never fully extracted.
+                    similarity_groups.csv and similarity_pairs.csv list the identical and similar notebooks, see
+                    similarityIndex() and dedup.
+                    run_report.json/.csv hold the wall time, CPU time and memory of each stage (ingest, dedup,
+                    autograde, score, generate_feedback, merge, store, analytics), see _timed(). The json also lists
+                    every notebook and the slow ones (more than 3x the median time), as does autograde_times.csv. The plots come from gradeAnalytics(), see analytics.
+                    feedback_aname.zip bundles the feedback HTML of every student for the LMS, see feedback.
+    Returns the Future of the background analytics (None unless analytics='background').
 
     ** NOTE: This is meant to be used with Blackboard Ultra structed files. This Function is to ONLY be used when autogradeing from the zip file. 
              See autogradeStudent() to autograde an individual student. **
     """
-    print('------------------------------------------------------------------------------------------')
-    input('Move Gradebook File and Blackboard Zip File into temp folder. Hit enter once this is done.')
-    print('------------------------------------------------------------------------------------------')
-    assert len(os.listdir(os.path.join(opath,'temp'))) == 2, '2 Files Expected'
+    import pandas as pd
 
     temppath = os.path.join(opath,'temp')
-    zname = next((z for z in os.listdir(temppath) if 'zip' in z), None)
-    gname = next((cs for cs in os.listdir(temppath) if 'csv' in cs), None)
+    from_temp = zip_path is None or gradebook_path is None
+    if from_temp:
+        print('------------------------------------------------------------------------------------------')
+        input('Move Gradebook File and Blackboard Zip File into temp folder. Hit enter once this is done.')
+        print('------------------------------------------------------------------------------------------')
+        assert len(os.listdir(temppath)) == 2, '2 Files Expected'
+
+        zname = next((z for z in os.listdir(temppath) if 'zip' in z), None)
+        gname = next((cs for cs in os.listdir(temppath) if 'csv' in cs), None)
+        zpath = os.path.join(temppath,zname)
+        gpath = os.path.join(temppath,gname)
+    else:
+        zpath, gpath = zip_path, gradebook_path
+        os.makedirs(temppath, exist_ok=True)
 
     coursepath = os.path.join(opath,coursename)
-    zpath = os.path.join(temppath,zname)
-    gpath = os.path.join(temppath,gname)
     scrpath = os.path.join(coursepath,'scratch')
-    subpath = os.path.join(coursepath,'submitted')
 
     assignment_scratch = os.path.join(scrpath,aname)
-    orgfiles = os.path.join(assignment_scratch,'orginal_files_from_bb')
 
     try:
         os.mkdir(assignment_scratch)
     except FileExistsError:
         pass
-    try:
-        os.mkdir(orgfiles)
-    except FileExistsError:
-        pass
 
-    def unzip(zip_path, extract_to):
-        """
-        Extracts all files from a zip archive.
-
-        Args:
-            zip_path (str): The path to the zip file.
-            extract_to (str): The directory to extract the contents to.
-        """
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_to)
+    timings = []
+    notebooks = None
+    with _timed(timings, 'ingest'):
+        usernames, copied, hashes, manifest = _ingest_zip(aname, coursepath, zpath, incremental)
+
+    to_grade, duplicates = copied, {}
+    with _timed(timings, 'dedup'):
+        if dedup:
+            to_grade, duplicates = _dedup_submissions(aname, coursename, opath, usernames, copied)
+
+    with _timed(timings, 'autograde'):
+        if to_grade and queue:
+            assert not warm_kernels, 'Warm kernels cannot be combined with the job queue'
+            queueAutograde(aname, coursename, users=to_grade, opath=opath, requeue=not incremental)
+            notebooks = _run_coroutine(runQueue(coursename, aname, opath=opath, workers=workers, timeout=timeout,
+                                                cpu_limit=cpu_limit, memory_limit=memory_limit,
+                                                callback=_print_progress))
+        elif to_grade and distributed:
+            assert not warm_kernels, 'Warm kernels cannot be combined with distributed grading'
+            notebooks = distributedAutograde(aname, coursename, users=to_grade, opath=opath, spool=spool,
+                                             local_workers=os.cpu_count() if workers is None else workers,
+                                             timeout=timeout, cpu_limit=cpu_limit, memory_limit=memory_limit)
+        elif to_grade:
+            # A single `nbgrader autograde` would also run the duplicates
+            if workers == 1 and timeout is None and cpu_limit is None and memory_limit is None and not warm_kernels \
+                    and not duplicates:
+                notebooks = _autograde_serial(coursepath, aname)
+            else:
+                notebooks = parallelAutograde(aname, coursename, users=to_grade, workers=workers, timeout=timeout,
+                                              opath=opath, cpu_limit=cpu_limit, memory_limit=memory_limit,
+                                              warm_kernels=warm_kernels, isolation=isolation)
+        _fan_out(coursepath, aname, duplicates)
 
-    unzip(zpath, orgfiles)
+    # One set of scores for gradebook.db, the feedback, the plots and Blackboard
+    with _timed(timings, 'score'):
+        scoreNotebooks(aname, coursename, users=copied, opath=opath)
+        question_matrix = questionScores(aname, coursename, opath=opath)
+        question_matrix.assign(total=question_matrix.sum(axis=1)).to_csv(os.path.join(assignment_scratch,'scores.csv'))
 
-    dirfiles = os.listdir(orgfiles)
+    with _timed(timings, 'generate_feedback'):
+        if feedback:
+            generateFeedback(aname, coursename, users=usernames, workers=workers, opath=opath)
 
-    notebooks = []
-    txts = []
-    usernames = []
+    _record_manifest(aname, coursepath, manifest, copied, hashes)
 
-    for f in range(len(dirfiles)-1):
-        f_txt, f_ipynb = dirfiles[f], dirfiles[f+1]
-        f_txt_ext = os.path.splitext(f_txt)[1]
-        f_ipynb_ext = os.path.splitext(f_ipynb)[1]
+    new_gradebook_path = f'{assignment_scratch}/org_gradebook.csv'
+    if from_temp:
+        os.rename(gpath, new_gradebook_path)
+        if archive_zip:
+            os.replace(zpath, os.path.join(assignment_scratch, zname))
+        else:
+            os.remove(zpath)
+    else:
+        shutil.copyfile(gpath, new_gradebook_path)
 
-        userpath = os.path.join(orgfiles, f_txt)
-        with open(userpath, 'r') as g:
-            firstline = g.readline().strip()
+    graded_gradebook = shutil.copyfile(new_gradebook_path, f'{assignment_scratch}/gradedAssignment.csv')
 
-        # Try extracting username only if parentheses exist
-        if '(' in firstline and ')' in firstline:
-            username = firstline[firstline.find('(') + 1:firstline.find(')')]
-        else:
-            username = 'UNKNOWN'
+    with _timed(timings, 'merge'):
+        finalgrades = pd.read_csv(graded_gradebook, dtype={'Username': str})
 
-        try:
-            assert f_txt_ext == '.txt'
-            assert f_ipynb_ext == '.ipynb'
-        except AssertionError:
-            if username != 'UNKNOWN':
-                print(f'Student {username} submitted a blank submission')
-            continue
+        score_col = _score_column(finalgrades, aname, score_col)
+        _merge_scores(finalgrades, question_matrix.sum(axis=1), score_col)
     
-        notebooks.append(f_ipynb)
-        txts.append(f_txt)
-        usernames.append(username)
-    print('------------------------------------------------------------------------------------------')
+        updated_scores = finalgrades[score_col].replace("Needs Grading", 0).fillna(0)
+        finalgrades[score_col] = pd.to_numeric(updated_scores, downcast='float')
     
-    for user, notebook in zip(usernames,notebooks):
-        usersubpath = os.path.join(subpath,user)
-        if os.path.exists(usersubpath):
-            src_path = os.path.join(orgfiles,notebook)
-        
-            student_assign_sub_path = os.path.join(usersubpath,aname)
-            try:
-                os.mkdir(student_assign_sub_path)
-            except FileExistsError:
-                pass
+        finalgrades.to_csv(graded_gradebook, index=False)
 
-            assignment_sub_path = os.path.join(student_assign_sub_path, f'{aname}.ipynb')
-        
-            shutil.copy2(src_path, assignment_sub_path)
-        else:
-            print(f'No submitted folder for student {user}.')
+    # The uploadable gradebook is ready before any analytics run
+    shutil.copyfile(f'{assignment_scratch}/gradedAssignment.csv', f'{temppath}/gradedAssignment.csv')
+    print(f'Uploadable gradebook written to {temppath}/gradedAssignment.csv')
 
-    os.chdir(coursepath)
-    subprocess.run(["nbgrader", "autograde", aname])
-    subprocess.run(["nbgrader", "generate_feedback", aname])
+    with _timed(timings, 'store'):
+        _store_question_scores(coursepath, aname, question_matrix=question_matrix)
 
-    new_gradebook_path = f'{assignment_scratch}/org_gradebook.csv'
-    os.rename(gpath, new_gradebook_path)
+    _score_summary(finalgrades, score_col, sum(_source_points(coursepath, aname).values()))
+
+    future = None
+    with _timed(timings, 'analytics'):
+        if analytics == 'inline':
+            gradeAnalytics(aname, coursename, opath=opath, users=usernames, score_col=score_col, show=True)
+        elif analytics == 'background':
+            future = _background(gradeAnalytics, aname, coursename, opath, usernames, score_col)
+            print(f'Plots and question statistics are being written to {assignment_scratch} in the background.')
+
+    _write_run_report(assignment_scratch, timings, notebooks)
+    print(f'Successfully Autograded Assignment {aname}!')
+    return future
+
+def _score_summary(finalgrades, score_col, totpts):
+    """
+    Prints the students with 0 or below 50% and the mean and standard deviation of score_col.
+    """
+    import pandas as pd
 
-    os.remove(zpath)
+    scores = pd.to_numeric(finalgrades[score_col], errors='coerce').fillna(0)
+    columns = ["First Name", "Last Name", "Username", score_col]
+
+    print("📍 Students with a score of 0:")
+    print(finalgrades.loc[scores == 0, columns].rename(columns={score_col: "grade"}).to_string(index=False))
+
+    print("\n📉 Students with a score below 50% (excluding 0):")
+    below_50 = (scores < totpts/2) & (scores > 0)
+    print(finalgrades.loc[below_50, columns].rename(columns={score_col: "grade"}).to_string(index=False))
 
-    # Pull grades from individual autograded assignments
-    autograded_qDist = []
-    for user in usernames:
-        if os.path.exists(os.path.join(os.getcwd(),'autograded',user,aname,f'{aname}.ipynb')):
-            grades = calculate_grades(aname, user, coursename, opath)
-            autograded_qDist.append(grades)
+    print(f"\n📊 Average Score: {scores.mean():.2f}")
+    print(f"📈 Standard Deviation: {scores.std():.2f}")
+
+# Single background worker for analytics, see _background()
+_analytics_pool = None
+
+def _background(fn, *args):
+    """
+    Runs fn(*args) in a background worker process and returns its Future. Jobs run one at a time in the order they
+    were submitted, and the worker is waited for when Python exits.
+    """
+    global _analytics_pool
+    if _analytics_pool is None:
+        _analytics_pool = ProcessPoolExecutor(max_workers=1)
+    return _analytics_pool.submit(fn, *args)
+
+def _question_stats(question_matrix, points):
+    """
+    n, max_points, mean and std of every question plus a histogram of how much of its points the students earned
+    (zero, up to 25%, 50%, 75% or 100%), all in one pass over the students x questions matrix. Questions that are
+    not in points use the highest score as their maximum. std is the sample standard deviation (ddof=1, 0 for a
+    single student), as in itemAnalysis() and scoreTrends().
+    """
+    import numpy as np
+    import pandas as pd
+
+    scores = question_matrix.fillna(0).to_numpy(dtype=float)
+    n = scores.shape[0]
+    top = np.array([points.get(q, 0.0) for q in question_matrix.columns], dtype=float)
+    top = np.where(top > 0, top, scores.max(axis=0, initial=0))
+
+    bands = np.ceil(4 * scores / np.where(top > 0, top, 1)).clip(0, 4).astype(int)
+    hist = (bands[:, :, None] == np.arange(5)).sum(axis=0)
+
+    stats = pd.DataFrame({'n': n, 'max_points': top,
+                          'mean': scores.mean(axis=0) if n else np.nan,
+                          'std': scores.std(axis=0, ddof=1) if n > 1 else (0.0 if n else np.nan)},
+                         index=question_matrix.columns)
+    stats[['zero', 'upto_25', 'upto_50', 'upto_75', 'upto_100']] = hist
+    stats.index.name = 'grade_id'
+    return stats
+
+def gradeAnalytics(aname, coursename, opath=os.getcwd(), users=None, score_col=None, show=False):
+    """
+    Grade distribution and per-question statistics of an assignment graded by autogradeAssignment(). This is a stage of
+    its own so that it can run in the background or later on, after the gradebook has been uploaded.
+
+    Figures are drawn straight onto matplotlib Figures (no pyplot, no GUI backend) so this runs headless and in a
+    background process.
+
+    -------------------------
+    Inputs
+    -------------------------
+    aname (str) : assignment name (not including extension).
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    users (list) : students to include in the question statistics. Default is everyone with a score for aname.
+    score_col (str) : Blackboard gradebook column of the assignment, see autogradeAssignment().
+    show (bool) : display the figures (in a notebook).
+
+    -------------------------
+    Outputs
+    -------------------------
+    scratch/aname : grade_dist.png (histogram of the Blackboard scores in gradedAssignment.csv), q_dist.png (mean and
+                    standard deviation per question) and question_stats.csv, see _question_stats().
+    Returns the question statistics as a pandas DataFrame indexed by grade_id.
+    """
+    import matplotlib
+    import numpy as np
+    import pandas as pd
+    from matplotlib.figure import Figure
+
+    coursepath = os.path.join(opath, coursename)
+    assignment_scratch = os.path.join(coursepath, 'scratch', aname)
+
+    finalgrades = pd.read_csv(os.path.join(assignment_scratch, 'gradedAssignment.csv'))
+    score_col = _score_column(finalgrades, aname, score_col)
+    totals = pd.to_numeric(finalgrades[score_col], errors='coerce').fillna(0).to_numpy()
+
+    points = _source_points(coursepath, aname)
+    question_matrix = questionScores(aname, coursename, users=users, opath=opath)
+    stats = _question_stats(question_matrix, points)
+    stats.to_csv(os.path.join(assignment_scratch, 'question_stats.csv'))
+
+    totpts = sum(points.values()) or float(totals.max(initial=0))
+    mean_score = totals.mean() if len(totals) else 0.0
+    figures = []
+    with matplotlib.rc_context({'font.family': 'serif'}):
+        fig = Figure(figsize=(8, 5), tight_layout=True)
+        ax = fig.subplots()
+        ax.hist(totals, bins=max(int(np.ceil(totpts)), 1), range=(0, max(totpts, 1)), edgecolor='black',
+                color='skyblue')
+        ax.set_title("Grade Distribution")
+        ax.set_xlabel("Score")
+        ax.set_ylabel("Number of Students")
+        ax.axvline(mean_score, color='red', linestyle='dashed', linewidth=1.5, label=f"Mean: {mean_score:.2f}")
+        ax.legend()
+        ax.grid(True, linestyle='--', alpha=0.5)
+        ax.set_xticks(range(0, int(np.ceil(totpts)) + 1))
+        fig.savefig(os.path.join(assignment_scratch, 'grade_dist.png'))
+        figures.append(os.path.join(assignment_scratch, 'grade_dist.png'))
+
+        if len(stats):
+            fig2 = Figure(figsize=(12, 6), tight_layout=True)
+            ax = fig2.subplots()
+            ax.bar(stats.index, stats['mean'].fillna(0), yerr=stats['std'].fillna(0), capsize=5, color='skyblue',
+                   edgecolor='black')
+            ax.set_title('Average Score per Question with Standard Deviation')
+            ax.set_xlabel('Question ID')
+            ax.set_ylabel('Average Score')
+            ax.grid(axis='y', linestyle='--', alpha=0.7)
+            fig2.savefig(os.path.join(assignment_scratch, 'q_dist.png'))
+            figures.append(os.path.join(assignment_scratch, 'q_dist.png'))
         else:
+            print(f'No question scores for {aname} yet, q_dist.png was not made.')
+
+    print('------------------------------------------------------------------------------------------')
+    print(stats.to_string(float_format='%.2f'))
+    if show:
+        from IPython.display import display, Image
+        for path in figures:
+            display(Image(filename=path))
+    return stats
+
+_STORE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS question_scores (
+        term TEXT NOT NULL, assignment TEXT NOT NULL, grade_id TEXT NOT NULL, student_id TEXT NOT NULL,
+        position INTEGER, score REAL, max_points REAL, recorded_at TEXT,
+        PRIMARY KEY (term, assignment, grade_id, student_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS question_scores_assignment ON question_scores (assignment, grade_id);
+    CREATE INDEX IF NOT EXISTS question_scores_student ON question_scores (student_id, term);
+"""
+
+def _store_question_scores(coursepath, aname, users=None, question_matrix=None):
+    """
+    Upserts the per-question scores of aname (see questionScores(), or question_matrix when it was already read)
+    into the analytics store coursepath/analytics.db, one row per term, assignment, question and student. The term is
+    the course folder name. Questions a student has no score for are stored as 0, like in the plots. Returns the
+    number of rows written.
+    """
+    import sqlite3
+
+    coursename = os.path.basename(coursepath)
+    if question_matrix is None:
+        question_matrix = questionScores(aname, coursename, users=users, opath=os.path.dirname(coursepath))
+    points = _source_points(coursepath, aname)
+    recorded_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    long_scores = question_matrix.fillna(0).stack().reset_index()
+    long_scores.columns = ['student_id', 'grade_id', 'score']
+    position = {q: i for i, q in enumerate(question_matrix.columns)}
+    rows = [(coursename, aname, q, str(user), position[q], float(score), points.get(q), recorded_at)
+            for user, q, score in long_scores.itertuples(index=False)]
+
+    con = sqlite3.connect(os.path.join(coursepath, 'analytics.db'))
+    try:
+        with con:
+            con.executescript(_STORE_SCHEMA)
+            con.executemany('INSERT OR REPLACE INTO question_scores VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    finally:
+        con.close()
+    return len(rows)
+
+def loadAnalytics(coursenames, opath=os.getcwd(), assignments=None):
+    """
+    Reads the per-question scores that every grading run stores in coursename/analytics.db.
+
+    -------------------------
+    Inputs
+    -------------------------
+    coursenames (str or list) : course folder(s) to read, e.g. one per term (['mae1117_fa24', 'mae1117_fa25']).
+    opath (str) : overhead path that houses the courses, see autogradeAssignment().
+    assignments (list) : assignment names to read. Default is every assignment.
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per term, assignment, question and student: term, assignment, grade_id,
+    student_id, position (of the question in the notebook), score, max_points and recorded_at.
+    """
+    import sqlite3
+    import pandas as pd
+
+    if isinstance(coursenames, str):
+        coursenames = [coursenames]
+    query = 'SELECT * FROM question_scores'
+    params = []
+    if assignments is not None:
+        query += f" WHERE assignment IN ({', '.join('?' * len(assignments))})"
+        params = list(assignments)
+
+    frames = []
+    for coursename in coursenames:
+        store = os.path.join(opath, coursename, 'analytics.db')
+        if not os.path.exists(store):
+            print(f'{coursename} has no analytics store yet, autograde an assignment first.')
             continue
-    
-    subprocess.run(["nbgrader", "export", "csv", aname])
+        con = sqlite3.connect(f'file:{store}?mode=ro', uri=True)
+        try:
+            frames.append(pd.read_sql_query(query, con, params=params))
+        finally:
+            con.close()
+    columns = ['term', 'assignment', 'grade_id', 'student_id', 'position', 'score', 'max_points', 'recorded_at']
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)[columns]
+
+def itemAnalysis(coursenames, opath=os.getcwd(), assignments=None):
+    """
+    Classical item statistics of every question, from the analytics store (see loadAnalytics()).
 
-    export_csv_path =  os.path.join(coursepath,'grades.csv')
-    assert os.path.exists(export_csv_path), 'Incorrect exported gradebook path'
+    difficulty is the mean share of the question's points that students earned (1 = everyone got full marks).
+    discrimination is the corrected item-total correlation: the correlation between the question's score and the
+    student's score on the rest of the assignment, so questions that good students get right and weak students get
+    wrong score close to 1. Both are computed for all terms, assignments and questions at once from grouped sums.
 
-    scrgradepath = os.path.join(assignment_scratch,'grades.csv')
-    os.rename(export_csv_path,scrgradepath)
+    -------------------------
+    Inputs
+    -------------------------
+    coursenames (str or list), opath (str), assignments (list) : see loadAnalytics().
 
-    graded_gradebook = shutil.copyfile(new_gradebook_path, f'{assignment_scratch}/gradedAssignment.csv')
-    
-    grades = pd.read_csv(scrgradepath)
-    assignmentgrades = grades.groupby("assignment").get_group(aname)
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per term, assignment and grade_id: n, max_points, mean, std (sample standard
+    deviation, ddof=1 and 0 for a single student, as in question_stats.csv), difficulty and discrimination (NaN when
+    the question or the rest of the assignment has no spread).
+    """
+    import numpy as np
+
+    scores = loadAnalytics(coursenames, opath, assignments)
+    keys = ['term', 'assignment']
+    x = scores['score'].astype(float)
+    y = scores.groupby(keys + ['student_id'])['score'].transform('sum') - x
+    scores = scores.assign(x=x, y=y, xy=x * y, xx=x * x, yy=y * y)
+
+    items = scores.groupby(keys + ['grade_id'], sort=False).agg(
+        position=('position', 'first'), n=('x', 'size'), max_points=('max_points', 'first'), sx=('x', 'sum'),
+        sy=('y', 'sum'), sxy=('xy', 'sum'), sxx=('xx', 'sum'), syy=('yy', 'sum'), std=('x', 'std'))
+    n = items['n']
+    items['mean'] = items['sx'] / n
+    items['std'] = items['std'].fillna(0)
+    items['difficulty'] = items['mean'] / items['max_points'].where(items['max_points'] > 0)
+    spread = (n * items['sxx'] - items['sx']**2) * (n * items['syy'] - items['sy']**2)
+    items['discrimination'] = (n * items['sxy'] - items['sx'] * items['sy']) / np.sqrt(spread.where(spread > 1e-12))
+
+    items = items.reset_index().sort_values(keys + ['position'])
+    return items[keys + ['grade_id', 'n', 'max_points', 'mean', 'std', 'difficulty', 'discrimination']].reset_index(
+        drop=True)
+
+def scoreTrends(coursenames, opath=os.getcwd(), assignments=None):
+    """
+    Assignment totals over assignments and terms, from the analytics store (see loadAnalytics()).
+
+    -------------------------
+    Inputs
+    -------------------------
+    coursenames (str or list), opath (str), assignments (list) : see loadAnalytics(). Terms are compared in the
+                                                                 order of coursenames.
 
-    finalgrades = pd.read_csv(graded_gradebook)
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per term and assignment: students, max_points and the mean, std and median of the
+    students' total as a percentage of max_points. change_from_previous_term is the difference in mean percentage to
+    the same assignment in the previous term listed, change_from_previous_assignment the difference to the
+    assignment graded before it in the same term.
+    """
+    if isinstance(coursenames, str):
+        coursenames = [coursenames]
+    scores = loadAnalytics(coursenames, opath, assignments)
+    keys = ['term', 'assignment']
+
+    max_points = scores.groupby(keys + ['grade_id'])['max_points'].first().groupby(level=keys).sum()
+    totals = scores.groupby(keys + ['student_id']).agg(total=('score', 'sum'), recorded_at=('recorded_at', 'min'))
+    totals = totals.join(max_points.rename('max_points'), on=keys)
+    totals['percent'] = 100 * totals['total'] / totals['max_points'].where(totals['max_points'] > 0)
+
+    trends = totals.groupby(level=keys).agg(
+        students=('percent', 'size'), max_points=('max_points', 'first'), mean_percent=('percent', 'mean'),
+        std_percent=('percent', 'std'), median_percent=('percent', 'median'), first_graded=('recorded_at', 'min'))
+    trends = trends.reset_index()
+    trends['term_order'] = trends['term'].map({term: i for i, term in enumerate(coursenames)})
+    trends = trends.sort_values(['term_order', 'first_graded']).reset_index(drop=True)
+
+    trends['change_from_previous_assignment'] = trends.groupby('term')['mean_percent'].diff()
+    trends['change_from_previous_term'] = trends.sort_values('term_order').groupby('assignment')['mean_percent'].diff()
+    return trends.drop(columns=['term_order'])
+
+def gradeAll(assignments, coursename, gradebook_path, opath=os.getcwd(), workers=None, timeout=None, incremental=True,
+             score_cols=None, cpu_limit=None, memory_limit=None, dedup=True):
+    """
+    Batch version of autogradeAssignment() for grading many assignments at once (e.g. regrading the whole term).
+    There are no prompts, so it can run unattended.
 
-    for user, score in zip(assignmentgrades['student_id'], assignmentgrades['score']):
-        iidx = finalgrades['Username'].tolist().index(user)
-        cols = finalgrades.columns
-        finalgrades.iat[iidx, -1] = score
-    
-    updated_scores = finalgrades[finalgrades.columns[-1]].replace("Needs Grading", 0).fillna(0)
-    finalgrades[finalgrades.columns[-1]] = pd.to_numeric(updated_scores, downcast='float')
-    
-    finalgrades.to_csv(graded_gradebook, index=False)
+    The submissions of every assignment are streamed from their zips first, then all autograde work is scheduled
+    through a single worker pool (see parallelAutograde()), the notebooks are scored with scoreNotebooks() and every
+    assignment's scores are merged into one Blackboard gradebook. No plots are made.
 
-    totpts = list(assignmentgrades['max_score'])[0]
+    -------------------------
+    Inputs
+    -------------------------
+    assignments (dict) : {aname: path to the Blackboard zip of that assignment}. Zips are left where they are.
+    coursename (str) : name of the course folder (not the path), see autogradeAssignment().
+    gradebook_path (str) : path to a Blackboard gradebook .csv that has a column for each assignment.
+    opath (str) : overhead path that houses the course, see autogradeAssignment().
+    workers (int) : number of worker processes shared by all assignments. Default is the number of CPUs.
+    timeout (float) : wall-clock limit in seconds for each student's notebook, see parallelAutograde().
+    cpu_limit, memory_limit : CPU seconds and memory (MB) each student's kernel may use, see parallelAutograde().
+    incremental (bool) : only autograde new or changed submissions, see autogradeAssignment().
+    score_cols (dict) : {aname: gradebook column name}. Assignments not listed are matched as in autogradeAssignment().
+    dedup (bool) : execute identical notebooks of an assignment only once, see autogradeAssignment().
 
-    # Get the last column name (assumed to be the score column)
-    score_col = finalgrades.columns[-1]
+    -------------------------
+    Outputs
+    -------------------------
+    temp/gradedAll.csv : uploadable gradebook to Blackboard with one score column per assignment.
+    scratch/ : gradedAll.csv, gradeAll_times.csv (time, CPU and memory per notebook) and gradeAll_report.json/.csv
+               (per-stage timings and slow notebooks, see autogradeAssignment()).
+    scratch/aname/scores.csv : points per question and total of every student, see autogradeAssignment().
+    scratch/aname/feedback_aname.zip : feedback bundle of each assignment, only changed feedback is regenerated (on
+                                       the same worker pool), see generateFeedback().
+    Returns the combined gradebook as a pandas DataFrame.
+    """
+    import pandas as pd
 
-    # Ensure scores are numeric (just in case any strings slipped in)
-    finalgrades[score_col] = pd.to_numeric(finalgrades[score_col], errors='coerce').fillna(0)
+    coursepath = os.path.join(opath, coursename)
+    scrpath = os.path.join(coursepath, 'scratch')
+    temppath = os.path.join(opath, 'temp')
+    score_cols = score_cols or {}
+
+    timings = []
+    ingested = {}
+    duplicates = {}
+    tasks = []
+    with _timed(timings, 'ingest'):
+        for aname, zpath in assignments.items():
+            print(f'------------------------------ {aname} ------------------------------')
+            ingested[aname] = _ingest_zip(aname, coursepath, zpath, incremental)
+            to_grade, duplicates[aname] = ingested[aname][1], {}
+            if dedup:
+                to_grade, duplicates[aname] = _dedup_submissions(aname, coursename, opath, ingested[aname][0],
+                                                                 to_grade)
+            tasks += [(aname, user) for user in to_grade]
+
+    with _timed(timings, 'autograde'):
+        results, used, elapsed = _autograde_pool(coursepath, tasks, os.path.join(scrpath, 'workers'), workers, timeout,
+                                                 cpu_limit, memory_limit)
+        for aname in assignments:
+            _fan_out(coursepath, aname, duplicates[aname])
+    notebooks = _autograde_summary(results, used, elapsed, os.path.join(scrpath, 'gradeAll_times.csv'))
+
+    question_matrices = {}
+    with _timed(timings, 'score'):
+        for aname, (usernames, copied, hashes, manifest) in ingested.items():
+            scoreNotebooks(aname, coursename, users=copied, opath=opath)
+            question_matrices[aname] = questionScores(aname, coursename, opath=opath)
+            question_matrices[aname].assign(total=question_matrices[aname].sum(axis=1)).to_csv(
+                os.path.join(scrpath, aname, 'scores.csv'))
+
+    with _timed(timings, 'generate_feedback'):
+        pending = {aname: _feedback_tasks(coursepath, aname) for aname in assignments}
+        fresults = _feedback_pool(coursepath, [(aname, user) for aname, (todo, _, _) in pending.items()
+                                               for user in todo], workers)
+        for aname, (todo, fhashes, fmanifest) in pending.items():
+            aresults = [r for r in fresults if r['assignment'] == aname]
+            sizes = _package_feedback(coursepath, aname, [r['student_id'] for r in aresults
+                                                          if r['status'] == 'generated'])
+            _feedback_summary(coursepath, aname, aresults, fhashes, fmanifest, sizes, len(fhashes) - len(todo))
+    for aname, (usernames, copied, hashes, manifest) in ingested.items():
+        _record_manifest(aname, coursepath, manifest, copied, hashes)
+
+    with _timed(timings, 'merge'):
+        finalgrades = pd.read_csv(gradebook_path, dtype={'Username': str})
+        columns = {aname: _score_column(finalgrades, aname, score_cols.get(aname)) for aname in assignments}
+        assert len(set(columns.values())) == len(columns), f'Assignments share gradebook columns {columns}, pass score_cols'
+        for aname, col in columns.items():
+            _merge_scores(finalgrades, question_matrices[aname].sum(axis=1), col)
+            updated_scores = finalgrades[col].replace("Needs Grading", 0).fillna(0)
+            finalgrades[col] = pd.to_numeric(updated_scores, downcast='float')
+
+    finalgrades.to_csv(os.path.join(scrpath, 'gradedAll.csv'), index=False)
+    shutil.copyfile(os.path.join(scrpath, 'gradedAll.csv'), os.path.join(temppath, 'gradedAll.csv'))
+
+    with _timed(timings, 'store'):
+        for aname in assignments:
+            _store_question_scores(coursepath, aname, question_matrix=question_matrices[aname])
+    _write_run_report(scrpath, timings, notebooks, name='gradeAll_report')
+    print(f'Successfully Autograded {len(assignments)} assignments: {", ".join(assignments)}')
+    return finalgrades
+
+# Student versions of synthetic question k, see makeSyntheticCourse()
+_SYNTHETIC_ANSWERS = {
+    'pass': 'def q{k}(x):\n    return {k} * x + 1',
+    'fail': 'def q{k}(x):\n    return {k} * x',
+    'error': "raise RuntimeError('synthetic error')\n\ndef q{k}(x):\n    return {k} * x + 1",
+    'timeout': 'while True:\n    pass\n\ndef q{k}(x):\n    return {k} * x + 1',
+}
+
+def makeSyntheticCourse(coursename, n_students, opath=os.getcwd(), aname='bench', n_questions=5, mix=None, seed=0):
+    """
+    Builds a course with fake students for measuring the grading pipeline without real student data. The course is
+    made with setupCourse() and createAssignment() from a generated Blackboard gradebook and instructor notebook,
+    next to a Blackboard zip with one submission (.txt receipt and notebook) per student.
+
+    Question k asks for q{k}(x) = k*x + 1 and is worth 1 to 3 points. The answer of every student to every question
+    is drawn from mix:
+        'pass'    : the correct solution.
+        'fail'    : a wrong result, the test's assert fails.
+        'error'   : the solution cell raises an exception.
+        'timeout' : the solution cell never finishes. nbgrader interrupts it after its cell timeout (30 s by default)
+                    unless the timeout of the grading run stops the whole notebook first, so keep it small.
 
-    # Filter students with a score of 0
-    zero_scores = finalgrades[finalgrades[score_col] == 0]
+    -------------------------
+    Inputs
+    -------------------------
+    coursename (str) : name of the course folder to create. An existing folder is only replaced if it was made by
+                       this function.
+    n_students (int) : number of students, all of whom submit.
+    opath (str) : overhead path to create the course in.
+    aname (str) : assignment name.
+    n_questions (int) : number of graded cells.
+    mix (dict) : {'pass': p, 'fail': p, 'error': p, 'timeout': p}, probabilities of each answer (normalised, missing
+                 ones are 0). Default {'pass': 0.7, 'fail': 0.2, 'error': 0.1}.
+    seed (int) : random seed, the same seed gives the same class.
 
-    # Filter students with score below 50
-    below_50 = finalgrades[(finalgrades[score_col] < totpts/2) & (finalgrades[score_col] > 0)]
+    -------------------------
+    Outputs
+    -------------------------
+    dict with 'zip' and 'gradebook' (paths of opath/coursename_aname.zip and opath/coursename_gradebook.csv),
+    'score_col' (the gradebook column of aname) and 'expected' (pandas DataFrame with username, answers, score and
+    max_score per student, also saved as opath/coursename_expected.csv).
+    """
+    import csv
+    import nbformat
+    import numpy as np
+    import pandas as pd
+    from nbformat.v4 import new_code_cell, new_markdown_cell, new_notebook
 
-    # Print students with 0
-    print("📍 Students with a score of 0:")
-    print(zero_scores[["First Name", "Last Name", "Username", score_col]].copy().rename(columns={score_col: "grade"}).to_string(index=False))
+    coursepath = os.path.join(opath, coursename)
+    marker = os.path.join(coursepath, '.synthetic')
+    if os.path.exists(coursepath):
+        assert os.path.exists(marker), f'{coursepath} exists and is not a synthetic course'
+        shutil.rmtree(coursepath)
+    os.makedirs(opath, exist_ok=True)
+
+    mix = mix or {'pass': 0.7, 'fail': 0.2, 'error': 0.1}
+    kinds = list(_SYNTHETIC_ANSWERS)
+    p = np.array([mix.get(kind, 0) for kind in kinds], dtype=float)
+    rng = np.random.default_rng(seed)
+    answers = rng.choice(len(kinds), size=(n_students, n_questions), p=p / p.sum())
+    points = np.array([1 + k % 3 for k in range(n_questions)])
+    users = [f'stu{i:05d}' for i in range(n_students)]
+
+    score_col = f'{aname} [Total Pts: {points.sum()} Score] |{100000 + seed}'
+    gradebook_path = os.path.join(opath, f'{coursename}_gradebook.csv')
+    with open(gradebook_path, 'w', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(['Last Name', 'First Name', 'Username', 'Student ID', 'Last Access', 'Availability', score_col])
+        for i, user in enumerate(users):
+            writer.writerow([f'Last{i}', f'First{i}', user, '', '', 'Yes', 'Needs Grading'])
+
+    setupCourse(coursename, folder_path=opath, gradebook_path=gradebook_path)
+    open(marker, 'w').close()
+
+    def meta(grade_id, **kw):
+        return {'nbgrader': dict(dict(grade=False, solution=False, locked=False, grade_id=grade_id, schema_version=3),
+                                 **kw)}
+
+    cells = [new_markdown_cell(f'# {aname}\nSynthetic assignment with {n_questions} questions.')]
+    for k in range(1, n_questions + 1):
+        cells += [new_code_cell(f'def q{k}(x):\n    ### BEGIN SOLUTION\n    return {k} * x + 1\n    ### END SOLUTION',
+                                metadata=meta(f'q{k}', solution=True)),
+                  new_code_cell(f'assert q{k}(2) == {2 * k + 1}\nassert q{k}(0) == 1',
+                                metadata=meta(f'test_q{k}', grade=True, locked=True, points=int(points[k - 1])))]
+    instructor = new_notebook(cells=cells)
+    instructor.metadata['kernelspec'] = {'name': 'python3', 'display_name': 'Python 3', 'language': 'python'}
+    instructor_path = os.path.join(opath, f'{coursename}_{aname}_instructor.ipynb')
+    nbformat.write(instructor, instructor_path)
+    createAssignment(aname, coursename, opath=opath, notebook_path=instructor_path)
+
+    release = nbformat.read(os.path.join(coursepath, 'release', aname, f'{aname}.ipynb'), as_version=4)
+    solution_cells = [i for i, cell in enumerate(release.cells)
+                      if cell.get('metadata', {}).get('nbgrader', {}).get('solution')]
+    zip_path = os.path.join(opath, f'{coursename}_{aname}.zip')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i, user in enumerate(users):
+            for k, cell in enumerate(solution_cells, start=1):
+                release.cells[cell].source = _SYNTHETIC_ANSWERS[kinds[answers[i, k - 1]]].format(k=k)
+            release.cells[solution_cells[0]].source = f'# {user}\n' + release.cells[solution_cells[0]].source
+            attempt = f'{aname}_{user}_attempt_2024-09-10-{12 + i // 3600 % 10:02d}-{i // 60 % 60:02d}-{i % 60:02d}'
+            zf.writestr(f'{attempt}.txt', f'Name: First{i} Last{i} ({user})\nAssignment: {aname}\n'
+                                          f'Files:\n\tOriginal filename: {aname}.ipynb\n'
+                                          f'\tFilename: {attempt}_{aname}.ipynb\n')
+            zf.writestr(f'{attempt}_{aname}.ipynb', nbformat.writes(release))
+
+    expected = pd.DataFrame({'username': users,
+                             'answers': [','.join(kinds[a] for a in row) for row in answers],
+                             'score': ((answers == kinds.index('pass')) * points).sum(axis=1).astype(float),
+                             'max_score': float(points.sum())})
+    expected.to_csv(os.path.join(opath, f'{coursename}_expected.csv'), index=False)
+    print(f'Synthetic course {coursename}: {n_students} students, {n_questions} questions, answers '
+          + ', '.join(f'{kind} {np.mean(answers == j):.0%}' for j, kind in enumerate(kinds)))
+    return {'zip': zip_path, 'gradebook': gradebook_path, 'score_col': score_col, 'expected': expected}
+
+def benchmarkPipeline(sizes=(50, 500, 5000), opath=os.path.join(os.getcwd(), 'benchmark'), workers=None,
+                      n_questions=5, mix=None, seed=0, update_baseline=False, tolerance=0.25, **grading_kwargs):
+    """
+    End-to-end benchmark of autogradeAssignment() on synthetic classes (see makeSyntheticCourse()) of each size,
+    compared against a stored baseline so that slowdowns show up as regressions.
 
-    # Print students below 50
-    print("\n📉 Students with a score below 50% (excluding 0):")
-    print(below_50[["First Name", "Last Name", "Username", score_col]].copy().rename(columns={score_col: "grade"}).to_string(index=False))
-    # Calculate and print statistics
-    mean_score = finalgrades[score_col].mean()
-    std_score = finalgrades[score_col].std()
-
-    print(f"\n📊 Average Score: {mean_score:.2f}")
-    print(f"📈 Standard Deviation: {std_score:.2f}")
-
-    # Plot distribution
-    plt.rcParams['font.family'] = 'serif'
-    fig = plt.figure(figsize=(8, 5))
-    plt.hist(finalgrades[score_col], bins=int(totpts), edgecolor='black', color='skyblue')
-    plt.title("Grade Distribution")
-    plt.xlabel("Score")
-    plt.ylabel("Number of Students")
-    plt.axvline(mean_score, color='red', linestyle='dashed', linewidth=1.5, label=f"Mean: {mean_score:.2f}")
-    plt.legend()
-    plt.grid(True, linestyle='--', alpha=0.5)
-    plt.xticks(range(0,int(totpts)+1))
-    plt.tight_layout()
-    plt.show()
-    fig.savefig(os.path.join(assignment_scratch, 'grade_dist.png'))
-    plt.close()
-
-    question_ids = [key for key in autograded_qDist[0] if key != 'total']
-    question_scores = {qid: [] for qid in question_ids}
-
-    # Fill in the scores
-    for student in autograded_qDist:
-        for qid in question_ids:
-            question_scores[qid].append(student.get(qid, 0))
-
-    # Compute average score per question
-    avg_scores = [np.mean(question_scores[qid]) for qid in question_ids]
-    std_devs = [np.std(question_scores[qid]) for qid in question_ids]
-
-    # Plot
-    fig2 = plt.figure(figsize=(12, 6))
-    bars = plt.bar(question_ids, avg_scores, yerr=std_devs, capsize=5, color='skyblue', edgecolor='black')
-
-    plt.title('Average Score per Question with Standard Deviation')
-    plt.xlabel('Question ID')
-    plt.ylabel('Average Score')
-    plt.grid(axis='y', linestyle='--', alpha=0.7)
-    plt.tight_layout()
-    plt.show()
-    fig2.savefig(os.path.join(assignment_scratch, 'q_dist.png'))
+    Every size gets a fresh course opath/bench<size>, graded from its zip with the grading output going to
+    opath/bench<size>.log. The stage timings come from the run report (see autogradeAssignment()), gradeAnalytics()
+    is timed as the 'analytics' stage and the uploadable scores are checked against the expected ones.
 
-    shutil.copyfile(f'{assignment_scratch}/gradedAssignment.csv', f'{temppath}/gradedAssignment.csv')
-    print(f'Successfully Autograded Assignment {aname}!')
+    -------------------------
+    Inputs
+    -------------------------
+    sizes (tuple) : class sizes to run.
+    opath (str) : folder for the synthetic courses, the results and the baseline.
+    workers (int) : worker processes for autogradeAssignment(), default one per CPU.
+    n_questions, mix, seed : synthetic class settings, see makeSyntheticCourse().
+    update_baseline (bool) : store this run as opath/benchmark_baseline.json. The first run always does.
+    tolerance (float) : a stage is a regression when it is more than this fraction (and 1 s) slower than the baseline.
+    grading_kwargs : passed on to autogradeAssignment(), e.g. timeout=60, warm_kernels=2.
+
+    -------------------------
+    Outputs
+    -------------------------
+    pandas DataFrame with one row per size and stage (plus 'total'): wall_seconds, cpu_seconds, peak_rss_mb (the
+    high-water mark of the grading process at the end of the stage, see _timed()), students_per_second, scores_match, baseline_seconds, change (fraction slower than the baseline) and regression.
+    Every run is appended to opath/benchmark_history.csv.
+    """
+    import platform
+    import pandas as pd
+
+    os.makedirs(opath, exist_ok=True)
+    machine = {'host': platform.node(), 'cpus': os.cpu_count(), 'python': platform.python_version()}
+    rows = []
+    for n in sizes:
+        coursename = f'bench{n}'
+        print(f'------------------------------ {n} students ------------------------------')
+        with open(os.path.join(opath, f'{coursename}.log'), 'w') as log, contextlib.redirect_stdout(log):
+            data = makeSyntheticCourse(coursename, n, opath, n_questions=n_questions, mix=mix, seed=seed)
+            start = time.perf_counter()
+            autogradeAssignment('bench', coursename, opath=opath, workers=workers, zip_path=data['zip'],
+                                gradebook_path=data['gradebook'], score_col=data['score_col'], analytics='off',
+                                **grading_kwargs)
+            timings = []
+            with _timed(timings, 'analytics'):
+                gradeAnalytics('bench', coursename, opath=opath, score_col=data['score_col'])
+            total = time.perf_counter() - start
+
+        with open(os.path.join(opath, coursename, 'scratch', 'bench', 'run_report.json'), 'r') as f:
+            stages = [s for s in json.load(f)['stages'] if s['stage'] != 'analytics'] + timings
+        graded = pd.read_csv(os.path.join(opath, coursename, 'scratch', 'bench', 'gradedAssignment.csv'))
+        scores = graded.set_index('Username')[data['score_col']].astype(float)
+        expected = data['expected'][~data['expected']['answers'].str.contains('timeout')].set_index('username')
+        match = bool((scores.reindex(expected.index) == expected['score']).all())
+        if not match:
+            print(f'⚠️ Scores of the {n} student class do not match the expected scores, see {coursename}.log')
+        for s in stages + [{'stage': 'total', 'wall_seconds': total,
+                            'cpu_seconds': sum(s['cpu_seconds'] for s in stages),
+                            'max_rss_mb': max(s['max_rss_mb'] for s in stages)}]:
+            rows.append({'size': n, 'stage': s['stage'], 'wall_seconds': s['wall_seconds'],
+                         'cpu_seconds': s['cpu_seconds'], 'peak_rss_mb': s['max_rss_mb'],
+                         'students_per_second': n / s['wall_seconds'] if s['wall_seconds'] else None,
+                         'scores_match': match})
+    results = pd.DataFrame(rows)
+
+    baseline_path = os.path.join(opath, 'benchmark_baseline.json')
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, 'r') as f:
+            stored = json.load(f)
+        baseline = stored['wall_seconds']
+        if stored['machine'] != machine:
+            print(f"⚠️ The baseline was recorded on {stored['machine']}, timings may not be comparable.")
+    results['baseline_seconds'] = [baseline.get(f'{n}/{stage}', float('nan'))
+                                   for n, stage in zip(results['size'], results['stage'])]
+    results['change'] = results['wall_seconds'] / results['baseline_seconds'] - 1
+    results['regression'] = ((results['change'] > tolerance)
+                             & (results['wall_seconds'] - results['baseline_seconds'] > 1))
+
+    history = results.assign(run=time.strftime('%Y-%m-%d %H:%M:%S'), host=machine['host'], workers=workers)
+    history_path = os.path.join(opath, 'benchmark_history.csv')
+    history.to_csv(history_path, mode='a', header=not os.path.exists(history_path), index=False)
+    if update_baseline or not baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump({'machine': machine, 'recorded': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'wall_seconds': {f'{n}/{stage}': wall for n, stage, wall
+                                        in zip(results['size'], results['stage'], results['wall_seconds'])}},
+                      f, indent=1)
+        print(f'Baseline written to {baseline_path}')
 
-def autogradeStudent(username, aname, coursename, opath=os.getcwd()):
+    print('------------------------------------------------------------------------------------------')
+    print(results.drop(columns='scores_match').to_string(index=False, float_format='%.2f'))
+    regressions = results[results['regression']]
+    if len(regressions):
+        print(f'\n🐢 {len(regressions)} stages are more than {tolerance:.0%} slower than the baseline:')
+        print(regressions[['size', 'stage', 'wall_seconds', 'baseline_seconds', 'change']].to_string(
+            index=False, float_format='%.2f'))
+    return results
+
+def _read_submission_grades(coursepath, aname, user):
+    """
+    Per-cell autograder results of one student's aname notebook from gradebook.db, in a JSON-friendly dict.
+    """
+    from nbgrader.api import Gradebook
+
+    with Gradebook('sqlite:///' + os.path.join(coursepath, 'gradebook.db'), os.path.basename(coursepath)) as gb:
+        nb = gb.find_submission_notebook(aname, aname, user)
+        return {'grades': {g.name: {'auto_score': g.auto_score, 'needs_manual_grade': g.needs_manual_grade}
+                           for g in nb.grades},
+                'comments': {c.name: c.auto_comment for c in nb.comments},
+                'late_submission_penalty': nb.late_submission_penalty,
+                'score': nb.score, 'max_score': nb.max_score}
+
+def _write_submission_grades(coursepath, aname, user, record):
+    """
+    Stores cached autograder results (see _read_submission_grades()) for a student in gradebook.db.
+    """
+    from nbgrader.api import Gradebook
+
+    with Gradebook('sqlite:///' + os.path.join(coursepath, 'gradebook.db'), os.path.basename(coursepath)) as gb:
+        gb.update_or_create_student(user)
+        gb.update_or_create_submission(aname, user)
+        nb = gb.find_submission_notebook(aname, aname, user)
+        nb.late_submission_penalty = record['late_submission_penalty']
+        for name, values in record['grades'].items():
+            grade = gb.find_grade(name, aname, aname, user)
+            grade.auto_score = values['auto_score']
+            grade.needs_manual_grade = values['needs_manual_grade']
+        for name, auto_comment in record['comments'].items():
+            gb.find_comment(name, aname, aname, user).auto_comment = auto_comment
+        gb.db.commit()
+
+def autogradeStudent(username, aname, coursename, opath=os.getcwd(), notebook_path=None, show=True, timeout=None,
+                     cpu_limit=None, memory_limit=None):
     """
     Function that will autograde for a specific student if the autograder has already been run on the whole class.
+    Only this student is autograded and gets new feedback, the rest of the class is left alone.
+
+    Results are cached in scratch/aname/cache/ under the hashes of the source notebook and of the submitted notebook.
+    Submitting the same notebook again (e.g. a re-upload) restores the autograded notebook, feedback and scores from
+    the cache instead of executing it.
 
     -------------------------
     Inputs
@@ -390,13 +3102,17 @@ def autogradeStudent(username, aname, coursename, opath=os.getcwd()):
     aname (str) : assignment name to grade (without the extension)
     coursename (str) : name of the autograded course, for more info see autogradeAssignment().
     opath (str) : overhead path that contains the course and the temp folder, see autogradeAssignment() for more detail. 
+    notebook_path (str) : path to the student's notebook. When given there is no prompt and the file is copied, not moved.
+    show (bool) : display the feedback HTML (in a notebook). Set to False when running from a script.
+    timeout, cpu_limit, memory_limit : wall-clock seconds, CPU seconds and memory (MB) the notebook may use, see
+                                       parallelAutograde(). A notebook that hits a limit gets no feedback.
 
     -------------------------
     Output
     -------------------------
-    HTML visual of the feedback for the student to directly pull the grade. 
+    HTML visual of the feedback for the student to directly pull the grade. The path of the feedback file is returned,
+    or None if autograding failed.
     """
-    from IPython.display import display, HTML
     
     subpath_student = os.path.join(opath,coursename,'submitted',username)
     assert os.path.exists(subpath_student), 'Student does not have a submitted folder.'
@@ -407,30 +3123,78 @@ def autogradeStudent(username, aname, coursename, opath=os.getcwd()):
     except FileExistsError:
         pass
 
-    temppath = os.path.join(opath,'temp')
-    input('Place student notebook into temp folder')
-    assert len(os.listdir(temppath)) == 1, 'temp folder contains to many files'
+    if notebook_path is None:
+        temppath = os.path.join(opath,'temp')
+        input('Place student notebook into temp folder')
+        assert len(os.listdir(temppath)) == 1, 'temp folder contains to many files'
 
-    notebookpath = os.path.join(temppath,os.listdir(temppath)[0])
+        notebookpath = os.path.join(temppath,os.listdir(temppath)[0])
 
-    os.rename(notebookpath, os.path.join(assignment_student_path,f'{aname}.ipynb'))
+        os.rename(notebookpath, os.path.join(assignment_student_path,f'{aname}.ipynb'))
+    else:
+        shutil.copyfile(notebook_path, os.path.join(assignment_student_path,f'{aname}.ipynb'))
     
     coursepath = os.path.join(opath, coursename)
-    os.chdir(coursepath)
-    subprocess.run(["nbgrader", "autograde", aname])
-    subprocess.run(["nbgrader", "generate_feedback", aname])
-
-    os.chdir('..')
+    autograded_student = os.path.join(coursepath,'autograded',username,aname)
+    feedback_folder = os.path.join(coursepath,'feedback',username,aname)
+
+    source_hash = _file_hash(os.path.join(coursepath,'source',aname,f'{aname}.ipynb'))
+    submission_hash = _file_hash(os.path.join(assignment_student_path,f'{aname}.ipynb'))
+    cache = os.path.join(coursepath,'scratch',aname,'cache',f'{source_hash[:16]}_{submission_hash[:16]}')
+
+    if os.path.exists(os.path.join(cache,'grades.json')):
+        print('Same notebook was graded before, using the cached results.')
+        for cached, dst in [(os.path.join(cache,'autograded'), autograded_student),
+                            (os.path.join(cache,'feedback'), feedback_folder)]:
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            shutil.copytree(cached, dst)
+        with open(os.path.join(cache,'grades.json'), 'r') as f:
+            record = json.load(f)
+        _write_submission_grades(coursepath, aname, username, record)
+    else:
+        status, message, _ = _run_nbgrader(["autograde", aname, "--student", username, "--force"], coursepath,
+                                           timeout, cpu_limit, memory_limit)
+        if status == 'graded' and memory_limit is not None and _memory_errors(autograded_student):
+            status, message = 'memory_limit', f'exceeded the {memory_limit} MB memory limit'
+        if status != 'graded':
+            print(f'Autograding {username} failed ({status}): {message}')
+            return None
+        scoreNotebooks(aname, coursename, users=[username], opath=opath)
+        generateFeedback(aname, coursename, users=[username], workers=1, opath=opath, force=True, bundle=False)
+        if not os.path.exists(os.path.join(feedback_folder,f'{aname}.html')):
+            print(f'Generating feedback for {username} failed, see the nbgrader output above.')
+            return None
+
+        record = _read_submission_grades(coursepath, aname, username)
+        if os.path.exists(cache):
+            shutil.rmtree(cache)
+        shutil.copytree(autograded_student, os.path.join(cache,'autograded'))
+        shutil.copytree(feedback_folder, os.path.join(cache,'feedback'))
+        with open(os.path.join(cache,'grades.json'), 'w') as f:
+            json.dump(record, f, indent=1)
+
+    # Keep the class manifest current so autogradeAssignment() does not regrade this notebook
+    assignment_scratch = os.path.join(coursepath,'scratch',aname)
+    manifest = _load_manifest(assignment_scratch)
+    if manifest['source'] == source_hash:
+        manifest['submissions'][username] = submission_hash
+        _save_manifest(assignment_scratch, manifest)
+    _store_question_scores(coursepath, aname, users=[username])
+    print(f"{username} scored {record['score']:g} / {record['max_score']:g} on {aname}")
     
     def read_html_file(file_path):
         with open(file_path, 'r') as file:
             html_content = file.read()
         return html_content
 
-    feedback_student = os.path.join(opath,coursename,'feedback',username,aname,f'{aname}.HTML')
-    display(HTML(read_html_file(feedback_student)))
+    feedback_student = os.path.join(opath,coursename,'feedback',username,aname,f'{aname}.html')
+    if show:
+        from IPython.display import display, HTML
+        display(HTML(read_html_file(feedback_student)))
+    return feedback_student
 
-def createAssignment(aname, coursename, opath=os.getcwd()):
+def createAssignment(aname, coursename, opath=os.getcwd(), notebook_path=None):
     """
     Validates an instructor's assignment notebook and generates the corresponding student version
     using `nbgrader`. The function expects a single instructor notebook to be manually placed into
@@ -452,6 +3216,9 @@ def createAssignment(aname, coursename, opath=os.getcwd()):
     opath : str, optional
         The base path where the course and temp folders are located.
         Defaults to the current working directory.
+    notebook_path : str, optional
+        Path to the instructor notebook. When given there is no prompt, the notebook is copied
+        instead of moved and the `temp/` folder is only used for the student copy.
 
     Notes:
     -----
@@ -472,46 +3239,50 @@ def createAssignment(aname, coursename, opath=os.getcwd()):
     """
     
     temppath = os.path.join(opath, 'temp')
-    input('Place instructor notebook into temp folder and press ENTER...')
+    if notebook_path is None:
+        input('Place instructor notebook into temp folder and press ENTER...')
     
-    files = os.listdir(temppath)
-    assert len(files) == 1, 'Temp folder contains too many files'
-    temp_assignment_path = os.path.join(temppath, files[0])
+        files = os.listdir(temppath)
+        assert len(files) == 1, 'Temp folder contains too many files'
+        temp_assignment_path = os.path.join(temppath, files[0])
+    else:
+        os.makedirs(temppath, exist_ok=True)
     
     assignment_folder_path = os.path.join(opath, coursename, 'source', aname)
     os.makedirs(assignment_folder_path, exist_ok=True)
     
     instructor_nb_path = os.path.join(assignment_folder_path, f'{aname}.ipynb')
-    os.rename(temp_assignment_path, instructor_nb_path)
-
-    os.chdir(os.path.join(opath, coursename, 'source', aname))
+    if notebook_path is None:
+        os.rename(temp_assignment_path, instructor_nb_path)
+    else:
+        shutil.copyfile(notebook_path, instructor_nb_path)
     
     print('Validating notebook...')
-    validate_result = subprocess.run(['nbgrader', 'validate', f'{aname}.ipynb'], capture_output=True, text=True)
+    validate_result = subprocess.run(['nbgrader', 'validate', f'{aname}.ipynb'], capture_output=True, text=True,
+                                     cwd=assignment_folder_path)
     
     # Check for validation issues in stdout
     if ("VALIDATION FAILED" in validate_result.stdout) or ("ERROR" in validate_result.stdout):
         print("Validation failed with errors:")
         print(validate_result.stdout)
-        os.rename(instructor_nb_path,f'{temppath}/failed.ipynb')
+        if notebook_path is None:
+            os.rename(instructor_nb_path,f'{temppath}/failed.ipynb')
         shutil.rmtree(assignment_folder_path)
-        os.chdir('../..')
         return
     
     print("Validation successful. Assigning notebook...")
 
-    os.chdir(os.path.join(opath, coursename))  # back to course root
-    subprocess.run(['nbgrader', 'generate_assignment', aname,'--force'])
+    coursepath = os.path.join(opath, coursename)
+    subprocess.run(['nbgrader', 'generate_assignment', aname,'--force'], cwd=coursepath)
 
-    student_nb_path = os.path.join('release', aname, f'{aname}.ipynb')
+    student_nb_path = os.path.join(coursepath, 'release', aname, f'{aname}.ipynb')
     temp_student_copy_path = os.path.join(temppath, f'{aname}.ipynb')
     
     shutil.copy(student_nb_path, temp_student_copy_path)
-    os.chdir('..')
     print(f'Student notebook copied to {temp_student_copy_path}')
     print(f'Assignment {aname} created succesfully!')
 
-def addStudent(coursename):
+def addStudent(coursename, first_name=None, last_name=None, username=None, opath=None):
     """
     Adds a new student to the nbgrader course database.
     
@@ -519,29 +3290,248 @@ def addStudent(coursename):
     ----------
     coursename : str
         The name of the course for which the student is being added.
+    first_name, last_name, username : str, optional
+        The student's details. Any that are not given are prompted for.
+    opath : str, optional
+        The base path where the course is located. Defaults to the current working directory.
     
     Notes:
     -----
-    - This function will prompt for the student's first name, last name, and username.
+    - This function will prompt for the student's first name, last name, and username if they are not given.
     - It will then create a new student entry in the nbgrader database for the specified course.
+    - To add many students at once (e.g. late enrollments), use syncRoster() with the updated Blackboard gradebook.
     """
     
-    opath = os.getcwd()
-
+    opath = opath or os.getcwd()
     coursepath = os.path.join(opath, coursename)
-    os.chdir(coursepath)
     
-    first_name = input("Enter student's first name: ")
-    last_name = input("Enter student's last name: ")
-    username = input("Enter student's username: ")
+    first_name = first_name or input("Enter student's first name: ")
+    last_name = last_name or input("Enter student's last name: ")
+    username = username or input("Enter student's username: ")
     
-    subprocess.run(["nbgrader", "db", "student", "add", username, "--first-name", first_name, "--last-name", last_name])
+    dbpath = os.path.join(coursepath, 'gradebook.db')
+    if os.path.exists(dbpath):
+        # One row in the student table, without importing nbgrader (seconds) just for this, see scoreNotebooks()
+        import sqlite3
+
+        con = sqlite3.connect(dbpath, timeout=30)
+        try:
+            with con:
+                con.execute("""
+                    INSERT INTO student (id, first_name, last_name) VALUES (?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET first_name = excluded.first_name, last_name = excluded.last_name
+                """, (username, first_name, last_name))
+        finally:
+            con.close()
+    else:
+        # nbgrader creates the database of a new course
+        from nbgrader.api import Gradebook
+
+        with Gradebook('sqlite:///' + dbpath, coursename) as gb:
+            gb.update_or_create_student(username, first_name=first_name, last_name=last_name)
     
     print(f'Student {first_name} {last_name} ({username}) added successfully!')
 
-    os.chdir(opath)  # Change back to the parent directory after adding the student
-
     subpath = os.path.join(coursepath, 'submitted')
     student_subpath = os.path.join(subpath, username)
-    os.mkdir(student_subpath)
+    os.makedirs(student_subpath, exist_ok=True)
     print(f'Submission folder created for {username} at {student_subpath}')
+
+def main(argv=None):
+    """
+    Command-line entry point so grading can run from cron or a batch scheduler without a notebook, e.g.
+
+        python gradingFunctions.py autograde ps1 mae1117 --zip ps1.zip --gradebook gc.csv --workers 8
+
+    Every subcommand takes its files as explicit arguments, so nothing is prompted for. Run with -h for the list.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local nbgrader autograding for Blackboard courses.')
+    parser.add_argument('--opath', default=os.getcwd(),
+                        help='overhead path that houses the course (default: current directory)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('setup-course', help='create an nbgrader course from a Blackboard gradebook')
+    p.add_argument('coursename')
+    p.add_argument('--gradebook', required=True, help='Blackboard gradebook .csv')
+
+    p = sub.add_parser('create-assignment', help='validate an instructor notebook and generate the student version')
+    p.add_argument('aname')
+    p.add_argument('coursename')
+    p.add_argument('--notebook', required=True, help='instructor notebook')
+
+    p = sub.add_parser('autograde', help='autograde an assignment from a Blackboard zip')
+    p.add_argument('aname')
+    p.add_argument('coursename')
+    p.add_argument('--zip', required=True, help='Blackboard submission zip')
+    p.add_argument('--gradebook', required=True, help='Blackboard gradebook .csv')
+    p.add_argument('--workers', type=int, default=1, help='worker processes (0 for one per CPU)')
+    p.add_argument('--timeout', type=float, help='wall-clock limit per notebook in seconds')
+    p.add_argument('--cpu-limit', type=int, help='CPU seconds per notebook kernel')
+    p.add_argument('--memory-limit', type=float, help='memory per notebook kernel in MB')
+    p.add_argument('--full', action='store_true', help='regrade every submission, not only new or changed ones')
+    p.add_argument('--score-col', help='Blackboard gradebook column of the assignment')
+    p.add_argument('--warm-kernels', type=int, default=0, help='pre-started kernels per worker (0 for one per notebook)')
+    p.add_argument('--isolation', choices=['restart', 'reset'], default='restart',
+                   help='fresh kernel per notebook, or reuse a kernel and only clear its namespace')
+    p.add_argument('--analytics', choices=['background', 'inline', 'off'], default='background',
+                   help='when to make the plots and question statistics')
+    p.add_argument('--no-feedback', action='store_true', help='skip feedback, run the feedback command later')
+    p.add_argument('--queue', action='store_true', help='grade through the resumable job queue')
+    p.add_argument('--no-dedup', action='store_true', help='execute identical notebooks once per student')
+    p.add_argument('--spool', help='grade through work bundles in this folder shared with worker processes or hosts, '
+                                   '--workers local workers are started (0 for none)')
+
+    p = sub.add_parser('worker', help='grade work bundles from the spool folder of a distributed autograde')
+    p.add_argument('spool')
+    p.add_argument('--worker-id', help='name of the worker (default HOSTNAME-PID)')
+    p.add_argument('--idle-exit', type=float, help='stop after this many seconds without work')
+
+    p = sub.add_parser('queue', help='put the submitted notebooks of an assignment on the job queue')
+    p.add_argument('aname')
+    p.add_argument('coursename')
+    p.add_argument('--job', help='job name (default ANAME)')
+    p.add_argument('--requeue', action='store_true', help='queue students again even if their notebook is unchanged')
+
+    p = sub.add_parser('run-queue', help='grade the pending notebooks of a job, resuming an interrupted run')
+    p.add_argument('coursename')
+    p.add_argument('job')
+    p.add_argument('--workers', type=int, default=0, help='notebooks graded at once (0 for one per CPU)')
+    p.add_argument('--timeout', type=float, help='wall-clock limit per notebook in seconds')
+    p.add_argument('--cpu-limit', type=int, help='CPU seconds per notebook kernel')
+    p.add_argument('--memory-limit', type=float, help='memory per notebook kernel in MB')
+
+    p = sub.add_parser('progress', help='progress of a job on the queue')
+    p.add_argument('coursename')
+    p.add_argument('job')
+
+    p = sub.add_parser('feedback', help='generate the feedback of students whose autograded notebook changed')
+    p.add_argument('aname')
+    p.add_argument('coursename')
+    p.add_argument('--workers', type=int, default=0, help='worker processes (0 for one per CPU)')
+    p.add_argument('--force', action='store_true', help='regenerate the feedback of every student')
+    p.add_argument('--max-mb', type=float, help='size cap of each feedback HTML in MB')
+    p.add_argument('--archive', action='store_true', help='also write a compressed zip per student')
+
+    p = sub.add_parser('similarity', help='group identical and similar submitted notebooks of an assignment')
+    p.add_argument('aname')
+    p.add_argument('coursename')
+    p.add_argument('--threshold', type=float, default=0.8, help='estimated similarity from which pairs are reported')
+
+    p = sub.add_parser('analytics', help='plots and question statistics of a graded assignment')
+    p.add_argument('aname')
+    p.add_argument('coursename')
+    p.add_argument('--score-col', help='Blackboard gradebook column of the assignment')
+
+    p = sub.add_parser('autograde-student', help='autograde a single student')
+    p.add_argument('username')
+    p.add_argument('aname')
+    p.add_argument('coursename')
+    p.add_argument('--notebook', required=True, help="student's notebook")
+    p.add_argument('--timeout', type=float, help='wall-clock limit in seconds')
+    p.add_argument('--cpu-limit', type=int, help='CPU seconds for the notebook kernel')
+    p.add_argument('--memory-limit', type=float, help='memory for the notebook kernel in MB')
+
+    p = sub.add_parser('sync-roster', help='add, update and remove students to match a Blackboard gradebook')
+    p.add_argument('coursename')
+    p.add_argument('--gradebook', required=True, help='Blackboard gradebook .csv')
+    p.add_argument('--remove', action='store_true', help='remove dropped students that have no submissions')
+    p.add_argument('--dry-run', action='store_true', help='only print the changes')
+
+    p = sub.add_parser('add-student', help='add a student to the course')
+    p.add_argument('coursename')
+    p.add_argument('--first-name', required=True)
+    p.add_argument('--last-name', required=True)
+    p.add_argument('--username', required=True)
+
+    p = sub.add_parser('grade-all', help='autograde several assignments in one batch')
+    p.add_argument('coursename')
+    p.add_argument('--gradebook', required=True, help='Blackboard gradebook .csv')
+    p.add_argument('--assignment', action='append', required=True, metavar='ANAME=ZIP',
+                   help='assignment name and its Blackboard zip, repeat for each assignment')
+    p.add_argument('--workers', type=int, default=0, help='worker processes (0 for one per CPU)')
+    p.add_argument('--timeout', type=float, help='wall-clock limit per notebook in seconds')
+    p.add_argument('--cpu-limit', type=int, help='CPU seconds per notebook kernel')
+    p.add_argument('--memory-limit', type=float, help='memory per notebook kernel in MB')
+    p.add_argument('--full', action='store_true', help='regrade every submission, not only new or changed ones')
+    p.add_argument('--no-dedup', action='store_true', help='execute identical notebooks once per student')
+
+    p = sub.add_parser('benchmark', help='time the grading pipeline on synthetic classes (in OPATH/benchmark)')
+    p.add_argument('--sizes', type=int, nargs='+', default=[50, 500, 5000], help='class sizes')
+    p.add_argument('--workers', type=int, default=0, help='worker processes (0 for one per CPU)')
+    p.add_argument('--questions', type=int, default=5, help='graded cells in the synthetic notebook')
+    p.add_argument('--timeout', type=float, help='wall-clock limit per notebook in seconds')
+    p.add_argument('--update-baseline', action='store_true', help='store this run as the regression baseline')
+    p.add_argument('--tolerance', type=float, default=0.25, help='slowdown that counts as a regression')
+
+    args = parser.parse_args(argv)
+    opath = os.path.abspath(args.opath)
+
+    # Figures are only saved to scratch/, never shown
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    if args.command == 'setup-course':
+        setupCourse(args.coursename, folder_path=opath, gradebook_path=os.path.abspath(args.gradebook))
+    elif args.command == 'create-assignment':
+        createAssignment(args.aname, args.coursename, opath=opath, notebook_path=os.path.abspath(args.notebook))
+    elif args.command == 'autograde':
+        # With --spool, --workers 0 means no local workers
+        workers = args.workers if args.spool else args.workers or None
+        autogradeAssignment(args.aname, args.coursename, opath=opath, workers=workers,
+                            timeout=args.timeout, incremental=not args.full, score_col=args.score_col,
+                            zip_path=os.path.abspath(args.zip), gradebook_path=os.path.abspath(args.gradebook),
+                            cpu_limit=args.cpu_limit, memory_limit=args.memory_limit,
+                            warm_kernels=args.warm_kernels, isolation=args.isolation, analytics=args.analytics,
+                            feedback=not args.no_feedback, queue=args.queue, dedup=not args.no_dedup,
+                            distributed=args.spool is not None,
+                            spool=os.path.abspath(args.spool) if args.spool else None)
+    elif args.command == 'worker':
+        gradingWorker(os.path.abspath(args.spool), worker_id=args.worker_id, idle_exit=args.idle_exit)
+    elif args.command == 'queue':
+        queueAutograde(args.aname, args.coursename, opath=opath, job=args.job, requeue=args.requeue)
+    elif args.command == 'run-queue':
+        asyncio.run(runQueue(args.coursename, args.job, opath=opath, workers=args.workers or None,
+                             timeout=args.timeout, cpu_limit=args.cpu_limit, memory_limit=args.memory_limit,
+                             callback=_print_progress))
+    elif args.command == 'progress':
+        progress = gradingProgress(args.coursename, args.job, opath=opath)
+        _print_progress(progress)
+        for f in progress['failures']:
+            print(f"{f['student_id']} ({f['assignment']}) {f['status']}: {f['message']}")
+    elif args.command == 'feedback':
+        generateFeedback(args.aname, args.coursename, workers=args.workers or None, opath=opath, force=args.force,
+                         max_mb=args.max_mb, archive=args.archive)
+    elif args.command == 'similarity':
+        similarityIndex(args.aname, args.coursename, opath=opath, threshold=args.threshold)
+    elif args.command == 'analytics':
+        gradeAnalytics(args.aname, args.coursename, opath=opath, score_col=args.score_col)
+    elif args.command == 'autograde-student':
+        feedback = autogradeStudent(args.username, args.aname, args.coursename, opath=opath,
+                                    notebook_path=os.path.abspath(args.notebook), show=False, timeout=args.timeout,
+                                    cpu_limit=args.cpu_limit, memory_limit=args.memory_limit)
+        if feedback is None:
+            parser.exit(1)
+        print(f'Feedback written to {feedback}')
+    elif args.command == 'sync-roster':
+        syncRoster(args.coursename, os.path.abspath(args.gradebook), opath=opath, remove=args.remove,
+                   dry_run=args.dry_run)
+    elif args.command == 'add-student':
+        addStudent(args.coursename, first_name=args.first_name, last_name=args.last_name, username=args.username,
+                   opath=opath)
+    elif args.command == 'grade-all':
+        assignments = dict(a.split('=', 1) for a in args.assignment)
+        assignments = {aname: os.path.abspath(zpath) for aname, zpath in assignments.items()}
+        gradeAll(assignments, args.coursename, os.path.abspath(args.gradebook), opath=opath,
+                 workers=args.workers or None, timeout=args.timeout, incremental=not args.full,
+                 cpu_limit=args.cpu_limit, memory_limit=args.memory_limit, dedup=not args.no_dedup)
+    elif args.command == 'benchmark':
+        results = benchmarkPipeline(tuple(args.sizes), opath=os.path.join(opath, 'benchmark'),
+                                    workers=args.workers or None, n_questions=args.questions,
+                                    update_baseline=args.update_baseline, tolerance=args.tolerance,
+                                    timeout=args.timeout)
+        if results['regression'].any() or not results['scores_match'].all():
+            parser.exit(1)
+
+if __name__ == '__main__':
+    main()